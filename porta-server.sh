@@ -5,6 +5,42 @@ UVICORN_PID_FILE="porta.pid"
 NGROK_PID_FILE="ngrok.pid"
 NGROK_URL_FILE="ngrok.url"
 
+# Ожидание готовности Porta по /readyz вместо фиксированной паузы
+wait_for_ready() {
+    local timeout=${1:-30}
+    local deadline=$(( $(date +%s) + timeout ))
+    while [ "$(date +%s)" -lt "$deadline" ]; do
+        if curl -sf "http://127.0.0.1:$PORT/readyz" > /dev/null 2>&1; then
+            return 0
+        fi
+        sleep 0.1
+    done
+    return 1
+}
+
+# Ожидание публичного URL от ngrok
+wait_for_ngrok_url() {
+    local timeout=${1:-15}
+    local deadline=$(( $(date +%s) + timeout ))
+    while [ "$(date +%s)" -lt "$deadline" ]; do
+        NGROK_PUBLIC_URL=$(curl -s http://127.0.0.1:4040/api/tunnels 2>/dev/null | grep -o 'https://[0-9a-zA-Z.-]*\.ngrok-free\.app' | head -n1)
+        if [ -n "$NGROK_PUBLIC_URL" ]; then
+            return 0
+        fi
+        sleep 0.2
+    done
+    return 1
+}
+
+# Ожидание освобождения порта после остановки
+wait_for_port_free() {
+    for _ in $(seq 1 50); do
+        lsof -i :$PORT > /dev/null 2>&1 || return 0
+        sleep 0.1
+    done
+    return 1
+}
+
 # Функция для проверки и очистки конфликтующих процессов
 cleanup_conflicts() {
     echo "🔍 Проверка конфликтующих процессов..."
@@ -49,16 +85,19 @@ start_server() {
     
     nohup uvicorn porta:app --host 0.0.0.0 --port $PORT > porta.log 2>&1 &
     echo $! > "$UVICORN_PID_FILE"
-    sleep 2
 
+    # ngrok стартует параллельно с инициализацией Porta
     echo "🌐 Запуск ngrok..."
     nohup ngrok http $PORT > ngrok.log 2>&1 &
     echo $! > "$NGROK_PID_FILE"
 
-    sleep 3
+    if wait_for_ready 30; then
+        echo "✅ Porta готов к работе"
+    else
+        echo "⚠️ Porta не сообщил о готовности за 30 секунд, см. porta.log и /readyz"
+    fi
 
-    NGROK_PUBLIC_URL=$(curl -s http://127.0.0.1:4040/api/tunnels | grep -o 'https://[0-9a-zA-Z.-]*\.ngrok-free\.app' | head -n1)
-    if [ -n "$NGROK_PUBLIC_URL" ]; then
+    if wait_for_ngrok_url 15; then
         echo "$NGROK_PUBLIC_URL" > "$NGROK_URL_FILE"
         echo "✅ MCP доступен по адресу: $NGROK_PUBLIC_URL"
         echo "💡 Примечание: При первом посещении может появиться предупреждение ngrok"
@@ -156,7 +195,7 @@ case "$1" in
         ;;
     restart)
         stop_server
-        sleep 1
+        wait_for_port_free
         start_server
         ;;
     status)
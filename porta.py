@@ -1,23 +1,62 @@
-from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import JSONResponse, HTMLResponse
+from fastapi import FastAPI, Request, HTTPException, WebSocket, WebSocketDisconnect, Query
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, HTMLResponse, PlainTextResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from subprocess import run, PIPE, TimeoutExpired
-from typing import Optional, List, Dict, Any
-from datetime import datetime
+from pydantic import BaseModel, ValidationError
+from starlette.concurrency import run_in_threadpool
+from subprocess import Popen, PIPE, DEVNULL, TimeoutExpired
+from typing import Optional, List, Dict, Any, Callable
+from datetime import datetime, timezone
 import uvicorn
 import logging
 import os
 import time
 import sqlite3
 import json
+import re
+import uuid
+import asyncio
+import hashlib
+import base64
+import binascii
+import threading
+import sys
+import tempfile
+import gzip
+import glob
+import fnmatch
+import struct
+import ctypes
+import ctypes.util
+import queue
+import stat
+import tarfile
+import zipfile
+import contextvars
+import math
+import itertools
+import mmap
+import signal
+import selectors
+import socket
+from collections import OrderedDict, Counter, deque
+from contextlib import asynccontextmanager
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="Porta MCP", description="Локальный интерфейс для агентов")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Сервер начинает принимать запросы сразу, тяжёлая инициализация идёт в фоне"""
+    threading.Thread(target=run_startup_components, name="porta-init", daemon=True).start()
+    yield
+    await run_in_threadpool(shutdown_components)
+
+
+app = FastAPI(title="Porta MCP", description="Локальный интерфейс для агентов", lifespan=lifespan)
 
 # Добавляем CORS middleware
 app.add_middleware(
@@ -50,6 +89,8 @@ START_TIME = time.time()
 
 # Путь к базе данных агентов
 AGENTS_DB = "agents.db"
+agents_db_ready = threading.Event()
+agents_db_lock = threading.Lock()
 
 def init_agents_db():
     """Инициализирует базу данных агентов"""
@@ -82,16 +123,57 @@ def init_agents_db():
             )
         ''')
         
+        # Таблица лимитов ресурсов агентов
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS agent_limits (
+                agent_id TEXT PRIMARY KEY,
+                cpu_seconds INTEGER,
+                memory_mb INTEGER,
+                max_processes INTEGER,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        # Агрегаты аналитики агентов по часовым бакетам
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS agent_stats (
+                agent_id TEXT,
+                operation_type TEXT,
+                bucket INTEGER,
+                count INTEGER DEFAULT 0,
+                errors INTEGER DEFAULT 0,
+                bytes INTEGER DEFAULT 0,
+                latency TEXT,
+                PRIMARY KEY (agent_id, operation_type, bucket)
+            )
+        ''')
+        
         conn.commit()
         conn.close()
+        agents_db_ready.set()
         logger.info("База данных агентов инициализирована")
     except Exception as e:
         logger.error(f"Ошибка инициализации БД агентов: {e}")
+        raise
+
+
+def ensure_agents_db():
+    """Создаёт схему БД при первом обращении, если фоновая инициализация ещё не успела"""
+    if not agents_db_ready.is_set():
+        with agents_db_lock:
+            if not agents_db_ready.is_set():
+                init_agents_db()
+
+
+def connect_agents_db() -> sqlite3.Connection:
+    """Открывает соединение с БД агентов"""
+    ensure_agents_db()
+    return sqlite3.connect(AGENTS_DB)
 
 def register_agent(agent_id: str, name: Optional[str] = None):
     """Регистрирует нового агента или обновляет существующего"""
     try:
-        conn = sqlite3.connect(AGENTS_DB)
+        conn = connect_agents_db()
         cursor = conn.cursor()
         
         # Проверяем, существует ли агент
@@ -117,15 +199,30 @@ def register_agent(agent_id: str, name: Optional[str] = None):
     except Exception as e:
         logger.error(f"Ошибка регистрации агента {agent_id}: {e}")
 
-def log_agent_operation(agent_id: str, operation_type: str, details: Dict[str, Any], success: bool = True):
-    """Логирует операцию агента в базу данных"""
+def payload_size(*parts) -> int:
+    """Размер полезной нагрузки операции в байтах (строки — в UTF-8)"""
+    return sum(len(part.encode("utf-8")) if isinstance(part, str) else len(part) for part in parts if part)
+
+
+def log_agent_operation(agent_id: str, operation_type: str, details: Dict[str, Any], success: bool = True,
+                        size: int = 0):
+    """Логирует операцию агента в базу данных и обновляет агрегаты аналитики.
+
+    size — байты данных, принятых и отданных операцией (содержимое файлов, команды
+    и их вывод, литералы синхронизации), а не размер записи аудита.
+    """
     try:
-        conn = sqlite3.connect(AGENTS_DB)
+        serialized = json.dumps(details)
+        started = request_started.get()
+        latency_ms = (time.time() - started) * 1000 if started else None
+        agent_analytics.record(agent_id, operation_type, success, latency_ms, size)
+        
+        conn = connect_agents_db()
         cursor = conn.cursor()
         
         cursor.execute(
             "INSERT INTO agent_operations (agent_id, operation_type, details, success) VALUES (?, ?, ?, ?)",
-            (agent_id, operation_type, json.dumps(details), success)
+            (agent_id, operation_type, serialized, success)
         )
         
         conn.commit()
@@ -133,13 +230,277 @@ def log_agent_operation(agent_id: str, operation_type: str, details: Dict[str, A
     except Exception as e:
         logger.error(f"Ошибка логирования операции агента {agent_id}: {e}")
 
+# ===== Аналитика агентов =====
+
+ANALYTICS_BUCKET_SECONDS = 3600         # Размер временного бакета
+ANALYTICS_RETENTION_BUCKETS = 24 * 7    # Сколько бакетов держать в памяти
+ANALYTICS_FLUSH_INTERVAL = 5            # Как часто сбрасывать изменения в БД, секунд
+
+# Время начала обработки текущего запроса, выставляется middleware
+request_started = contextvars.ContextVar("request_started", default=None)
+
+
+class LatencySketch:
+    """Логарифмическая гистограмма задержек (DDSketch) с относительной точностью 1%.
+
+    Скетчи объединяются сложением счётчиков, поэтому бакеты можно сворачивать
+    в итоги по агенту без пересчёта исходных операций.
+    """
+
+    ACCURACY = 0.01
+    GAMMA = (1 + ACCURACY) / (1 - ACCURACY)
+    LOG_GAMMA = math.log(GAMMA)
+
+    def __init__(self):
+        self.buckets = {}
+        self.zero = 0
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value: float):
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+        if value <= 1e-3:
+            self.zero += 1
+            return
+        index = math.ceil(math.log(value) / self.LOG_GAMMA)
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+
+    def merge(self, other: "LatencySketch"):
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+        self.zero += other.zero
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+
+    def quantile(self, q: float) -> Optional[float]:
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zero
+        if seen > rank:
+            return 0.0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen > rank:
+                return round(min(2 * self.GAMMA ** index / (self.GAMMA + 1), self.max), 3)
+        return round(self.max, 3)
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "count": self.count,
+            "avg_ms": round(self.total / self.count, 3) if self.count else None,
+            "p50_ms": self.quantile(0.5),
+            "p90_ms": self.quantile(0.9),
+            "p99_ms": self.quantile(0.99),
+            "max_ms": round(self.max, 3) if self.count else None
+        }
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"b": self.buckets, "z": self.zero, "n": self.count, "s": self.total, "m": self.max}
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "LatencySketch":
+        sketch = cls()
+        sketch.buckets = {int(k): v for k, v in data.get("b", {}).items()}
+        sketch.zero = data.get("z", 0)
+        sketch.count = data.get("n", 0)
+        sketch.total = data.get("s", 0.0)
+        sketch.max = data.get("m", 0.0)
+        return sketch
+
+
+class Rollup:
+    """Агрегат операций: количество, ошибки, объём данных и задержки"""
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.bytes = 0
+        self.latency = LatencySketch()
+
+    def add(self, success: bool, latency_ms: Optional[float], size: int):
+        self.count += 1
+        self.errors += 0 if success else 1
+        self.bytes += size
+        if latency_ms is not None:
+            self.latency.add(latency_ms)
+
+    def merge(self, other: "Rollup"):
+        self.count += other.count
+        self.errors += other.errors
+        self.bytes += other.bytes
+        self.latency.merge(other.latency)
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "error_rate": round(self.errors / self.count, 4) if self.count else 0.0,
+            "bytes": self.bytes,
+            "latency": self.latency.summary()
+        }
+
+
+class AgentAnalytics:
+    """Инкрементальные агрегаты по агенту, типу операции и временному бакету"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets = {}   # (agent_id, operation_type, bucket) -> Rollup
+        self.totals = {}    # agent_id -> {operation_type -> Rollup}
+        self.dirty = set()
+        self.last_flush = time.time()
+        self.loaded = False
+
+    def load(self):
+        """Загружает сохранённые агрегаты из БД (один раз, при старте)"""
+        if self.loaded:
+            return
+        try:
+            conn = connect_agents_db()
+            cursor = conn.cursor()
+            cursor.execute("SELECT agent_id, operation_type, bucket, count, errors, bytes, latency FROM agent_stats")
+            rows = cursor.fetchall()
+            conn.close()
+        except Exception as e:
+            # Без загрузки flush затёр бы сохранённые бакеты частичными счётчиками
+            logger.error(f"Ошибка загрузки аналитики агентов: {e}")
+            raise
+
+        oldest = self.current_bucket() - ANALYTICS_RETENTION_BUCKETS * ANALYTICS_BUCKET_SECONDS
+        with self.lock:
+            # Операции, записанные до окончания загрузки, досливаются поверх сохранённых
+            recorded_buckets, recorded_totals = self.buckets, self.totals
+            self.buckets, self.totals = {}, {}
+            for agent_id, operation_type, bucket, count, errors, size, latency in rows:
+                rollup = Rollup()
+                rollup.count, rollup.errors, rollup.bytes = count, errors, size
+                rollup.latency = LatencySketch.from_dict(json.loads(latency) if latency else {})
+                self.totals.setdefault(agent_id, {}).setdefault(operation_type, Rollup()).merge(rollup)
+                if bucket >= oldest:
+                    self.buckets[(agent_id, operation_type, bucket)] = rollup
+            for key, rollup in recorded_buckets.items():
+                self.buckets.setdefault(key, Rollup()).merge(rollup)
+            for agent_id, operations in recorded_totals.items():
+                for operation_type, rollup in operations.items():
+                    self.totals.setdefault(agent_id, {}).setdefault(operation_type, Rollup()).merge(rollup)
+            self.loaded = True
+        logger.info(f"Аналитика агентов загружена: {len(rows)} бакетов")
+
+    @staticmethod
+    def current_bucket() -> int:
+        return int(time.time() // ANALYTICS_BUCKET_SECONDS * ANALYTICS_BUCKET_SECONDS)
+
+    def record(self, agent_id: str, operation_type: str, success: bool, latency_ms: Optional[float], size: int):
+        bucket = self.current_bucket()
+        key = (agent_id, operation_type, bucket)
+        with self.lock:
+            rollup = self.buckets.get(key)
+            if rollup is None:
+                rollup = self.buckets[key] = Rollup()
+                self.evict(bucket)
+            rollup.add(success, latency_ms, size)
+            self.totals.setdefault(agent_id, {}).setdefault(operation_type, Rollup()).add(success, latency_ms, size)
+            self.dirty.add(key)
+            should_flush = time.time() - self.last_flush >= ANALYTICS_FLUSH_INTERVAL
+        if should_flush:
+            self.flush()
+
+    def evict(self, bucket: int):
+        oldest = bucket - ANALYTICS_RETENTION_BUCKETS * ANALYTICS_BUCKET_SECONDS
+        for key in [k for k in self.buckets if k[2] < oldest]:
+            del self.buckets[key]
+
+    def flush(self):
+        """Сохраняет изменённые бакеты в БД (только после успешной загрузки)"""
+        with self.lock:
+            if not self.loaded:
+                return
+            rows = []
+            keys = set(self.dirty)
+            for key in self.dirty:
+                rollup = self.buckets.get(key)
+                if rollup:
+                    rows.append((*key, rollup.count, rollup.errors, rollup.bytes,
+                                 json.dumps(rollup.latency.to_dict())))
+            self.dirty.clear()
+            self.last_flush = time.time()
+        if not rows:
+            return
+        try:
+            conn = connect_agents_db()
+            conn.executemany(
+                """INSERT INTO agent_stats (agent_id, operation_type, bucket, count, errors, bytes, latency)
+                   VALUES (?, ?, ?, ?, ?, ?, ?)
+                   ON CONFLICT(agent_id, operation_type, bucket) DO UPDATE SET
+                       count = excluded.count,
+                       errors = excluded.errors,
+                       bytes = excluded.bytes,
+                       latency = excluded.latency""",
+                rows
+            )
+            conn.commit()
+            conn.close()
+        except Exception as e:
+            logger.error(f"Ошибка сохранения аналитики агентов: {e}")
+            with self.lock:
+                self.dirty.update(keys)
+
+    def agent_stats(self, agent_id: str, operation_type: Optional[str], hours: int) -> Dict[str, Any]:
+        with self.lock:
+            operations = self.totals.get(agent_id, {})
+            if operation_type:
+                operations = {k: v for k, v in operations.items() if k == operation_type}
+            overall = Rollup()
+            for rollup in operations.values():
+                overall.merge(rollup)
+
+            current = self.current_bucket()
+            timeline = []
+            for step in range(min(hours, ANALYTICS_RETENTION_BUCKETS) - 1, -1, -1):
+                bucket = current - step * ANALYTICS_BUCKET_SECONDS
+                merged = Rollup()
+                for op in operations:
+                    rollup = self.buckets.get((agent_id, op, bucket))
+                    if rollup:
+                        merged.merge(rollup)
+                if merged.count:
+                    timeline.append({
+                        "bucket": datetime.fromtimestamp(bucket).isoformat(),
+                        **merged.summary()
+                    })
+
+            return {
+                "overall": overall.summary(),
+                "operations": {op: rollup.summary() for op, rollup in operations.items()},
+                "timeline": timeline
+            }
+
+    def all_agents(self) -> Dict[str, Any]:
+        with self.lock:
+            result = {}
+            for agent_id, operations in self.totals.items():
+                overall = Rollup()
+                for rollup in operations.values():
+                    overall.merge(rollup)
+                result[agent_id] = overall.summary()
+            return result
+
+
+agent_analytics = AgentAnalytics()
+
+
 def get_uptime():
     """Возвращает время работы сервера в секундах"""
     return int(time.time() - START_TIME)
 
-# Инициализируем базу данных при запуске
-init_agents_db()
-
+def is_forbidden_path(path: str) -> bool:
+    """Простейшая проверка пути на выход за пределы разрешённых директорий"""
+    return ".." in path or path.startswith(("/etc", "/dev", "/proc"))
 
 @app.middleware("http")
 async def verify_token(request: Request, call_next):
@@ -148,15 +509,301 @@ async def verify_token(request: Request, call_next):
     return await call_next(request)
 
 
-def log_agent_call(agent_id: str, method: str, result: dict):
-    """Логирует вызов агента с timestamp и в базу данных"""
+# ===== Адаптивное ограничение параллелизма =====
+
+CONCURRENCY_INITIAL = int(os.getenv("PORTA_CONCURRENCY_INITIAL", 20))
+CONCURRENCY_MIN = int(os.getenv("PORTA_CONCURRENCY_MIN", 4))
+CONCURRENCY_MAX = int(os.getenv("PORTA_CONCURRENCY_MAX", 200))
+CONCURRENCY_PRIORITY_RESERVE = 4    # Сверх лимита только для дешёвых эндпоинтов
+CONCURRENCY_RETRY_AFTER = 1         # Секунд, заголовок Retry-After при отказе
+
+# Дешёвые эндпоинты, которые обслуживаются даже при перегрузке
+CONCURRENCY_PRIORITY_PATHS = ("/meta", "/agent/status", "/healthz", "/readyz")
+# Долгоживущие запросы, которые не участвуют в лимите
+CONCURRENCY_EXEMPT_PREFIXES = ("/debug/", "/watch")
+
+
+class AdaptiveConcurrencyLimiter:
+    """Градиентный ограничитель параллелизма по наблюдаемой задержке.
+
+    Раз в окно сравнивает минимальную задержку окна с долгосрочной базовой:
+    пока они близки, лимит растёт на sqrt(limit), при росте очереди лимит
+    уменьшается пропорционально градиенту.
+    """
+
+    TOLERANCE = 2.0
+    SMOOTHING = 0.2
+    WINDOW_SECONDS = 1.0
+    WINDOW_MIN_SAMPLES = 10
+
+    def __init__(self, initial: int, min_limit: int, max_limit: int):
+        self.lock = threading.Lock()
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.inflight = 0
+        self.max_inflight_window = 0
+        self.long_rtt = None
+        self.window_min_rtt = None
+        self.window_samples = 0
+        self.window_started = time.monotonic()
+        self.accepted = 0
+        self.shed = 0
+
+    def try_acquire(self, priority: bool) -> bool:
+        with self.lock:
+            allowed = int(self.limit) + (CONCURRENCY_PRIORITY_RESERVE if priority else 0)
+            if self.inflight >= allowed:
+                self.shed += 1
+                return False
+            self.inflight += 1
+            self.accepted += 1
+            self.max_inflight_window = max(self.max_inflight_window, self.inflight)
+            return True
+
+    def release(self, latency: float):
+        with self.lock:
+            self.inflight -= 1
+            self.window_samples += 1
+            if self.window_min_rtt is None or latency < self.window_min_rtt:
+                self.window_min_rtt = latency
+
+            now = time.monotonic()
+            if self.window_samples < self.WINDOW_MIN_SAMPLES or now - self.window_started < self.WINDOW_SECONDS:
+                return
+            self.update_limit(self.window_min_rtt)
+            self.window_min_rtt = None
+            self.window_samples = 0
+            self.max_inflight_window = self.inflight
+            self.window_started = now
+
+    def update_limit(self, rtt: float):
+        if self.long_rtt is None:
+            self.long_rtt = rtt
+        else:
+            self.long_rtt = 0.95 * self.long_rtt + 0.05 * rtt
+            # Если нагрузка спала, базовая задержка быстро следует вниз
+            if self.long_rtt / max(rtt, 1e-6) > 2:
+                self.long_rtt *= 0.95
+
+        gradient = max(0.5, min(1.0, self.TOLERANCE * self.long_rtt / max(rtt, 1e-6)))
+        if gradient >= 1.0 and self.max_inflight_window < self.limit / 2:
+            # Нагрузка ниже лимита — расти незачем
+            return
+        new_limit = self.limit * gradient + math.sqrt(self.limit)
+        new_limit = self.limit * (1 - self.SMOOTHING) + new_limit * self.SMOOTHING
+        self.limit = max(self.min_limit, min(self.max_limit, new_limit))
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                "limit": int(self.limit),
+                "inflight": self.inflight,
+                "baseline_latency_ms": round(self.long_rtt * 1000, 3) if self.long_rtt else None,
+                "accepted": self.accepted,
+                "shed": self.shed
+            }
+
+
+concurrency_limiter = AdaptiveConcurrencyLimiter(CONCURRENCY_INITIAL, CONCURRENCY_MIN, CONCURRENCY_MAX)
+
+
+# ===== Запись трафика для воспроизведения =====
+
+CAPTURE_PATH = os.getenv("PORTA_CAPTURE")  # Файл трассы (.jsonl или .jsonl.gz); не задан — запись выключена
+CAPTURE_SKIP_PREFIXES = ("/debug/", "/watch", "/healthz", "/readyz", "/web", "/docs", "/openapi.json", "/archive/upload")
+CAPTURE_REDACT_FIELDS = ("content", "data")  # Заменяются маркером с длиной
+# Команды и код могут содержать пароли и токены: по умолчанию тоже только длина
+CAPTURE_COMMAND_FIELDS = ("cmd", "commands", "code", "args")
+CAPTURE_KEEP_COMMANDS = os.getenv("PORTA_CAPTURE_COMMANDS") == "1"
+
+
+def redact_value(item: Any) -> Any:
+    """Заменяет строку (или строки списка) маркером с длиной"""
+    if isinstance(item, str):
+        return {"__redacted__": len(item)}
+    if isinstance(item, list):
+        return [redact_value(element) for element in item]
+    return item
+
+
+def sanitize_payload(value: Any) -> Any:
+    """Убирает содержимое файлов, команды и код, обезличивает agent_id, сохраняя форму запроса"""
+    if isinstance(value, dict):
+        result = {}
+        for key, item in value.items():
+            if key in CAPTURE_REDACT_FIELDS and isinstance(item, str):
+                result[key] = {"__redacted__": len(item)}
+            elif key in CAPTURE_COMMAND_FIELDS and not CAPTURE_KEEP_COMMANDS:
+                result[key] = redact_value(item)
+            elif key == "agent_id" and isinstance(item, str):
+                result[key] = "agent-" + hashlib.sha256(item.encode()).hexdigest()[:8]
+            else:
+                result[key] = sanitize_payload(item)
+        return result
+    if isinstance(value, list):
+        return [sanitize_payload(item) for item in value]
+    return value
+
+
+class TrafficRecorder:
+    """Пишет обезличенные запросы с таймингами в компактный JSONL-файл"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.file = gzip.open(path, "at", encoding="utf-8") if path.endswith(".gz") else open(path, "a", encoding="utf-8")
+        self.write({"trace": "porta", "version": 1, "started": datetime.now().isoformat()})
+        logger.info(f"Запись трафика включена: {path}")
+
+    def write(self, record: Dict[str, Any]):
+        with self.lock:
+            self.file.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n")
+            self.file.flush()
+
+    def record(self, started: float, method: str, path: str, query: str, body: bytes, status: int, duration: float):
+        payload = None
+        if body:
+            try:
+                payload = sanitize_payload(json.loads(body))
+            except ValueError:
+                payload = {"__redacted__": len(body)}
+        record = {"t": round(started, 3), "m": method, "p": path,
+                  "s": status, "d": round(duration * 1000, 2)}
+        if query:
+            record["q"] = query
+        if payload is not None:
+            record["b"] = payload
+        self.write(record)
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+traffic_recorder = TrafficRecorder(CAPTURE_PATH) if CAPTURE_PATH else None
+
+
+# ===== Middleware запросов =====
+
+def overload_response() -> JSONResponse:
+    return JSONResponse(
+        content={"detail": "Сервер перегружен, повторите запрос позже"},
+        status_code=503,
+        headers={"Retry-After": str(CONCURRENCY_RETRY_AFTER)}
+    )
+
+
+class RequestMiddleware:
+    """Чистый ASGI-middleware для HTTP-запросов: время начала для аналитики,
+    адаптивный лимит параллелизма и запись трафика (только при PORTA_CAPTURE).
+
+    Без BaseHTTPMiddleware: запрос не порождает отдельную задачу и поток тела ответа.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_started.set(time.time())
+        path = scope["path"]
+        if traffic_recorder is None or path.startswith(CAPTURE_SKIP_PREFIXES):
+            await self.limit(scope, receive, send)
+            return
+
+        # Запись трафика: тело запроса копится по мере чтения приложением
+        started = time.time()
+        body = bytearray()
+        status = 500
+
+        async def receive_body():
+            message = await receive()
+            if message["type"] == "http.request":
+                body.extend(message.get("body", b""))
+            return message
+
+        async def send_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.limit(scope, receive_body, send_status)
+        finally:
+            try:
+                traffic_recorder.record(started, scope["method"], path,
+                                        scope.get("query_string", b"").decode("latin-1"),
+                                        bytes(body), status, time.time() - started)
+            except Exception as e:
+                logger.error(f"Ошибка записи трафика: {e}")
+
+    async def limit(self, scope, receive, send):
+        """Отбрасывает запросы сверх адаптивного лимита с 503 и Retry-After"""
+        path = scope["path"]
+        if path.startswith(CONCURRENCY_EXEMPT_PREFIXES):
+            await self.app(scope, receive, send)
+            return
+
+        if not concurrency_limiter.try_acquire(priority=path in CONCURRENCY_PRIORITY_PATHS):
+            logger.warning(f"Перегрузка: запрос {path} отклонён (лимит {int(concurrency_limiter.limit)})")
+            await overload_response()(scope, receive, send)
+            return
+
+        started = time.monotonic()
+        latency = None
+
+        async def send_timed(message):
+            nonlocal latency
+            # Задержка для градиента — до начала ответа, потоковая выдача её не растягивает
+            if message["type"] == "http.response.start" and latency is None:
+                latency = time.monotonic() - started
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_timed)
+        finally:
+            concurrency_limiter.release(latency if latency is not None else time.monotonic() - started)
+
+
+app.add_middleware(RequestMiddleware)
+
+
+def log_agent_call(agent_id: str, method: str, result: dict, size: int = 0):
+    """Логирует вызов агента с timestamp и в базу данных; size — объём данных операции"""
     timestamp = datetime.now().isoformat()
     logger.info(f"[AGENT] {agent_id} called {method}: {result} at {timestamp}")
     
     # Регистрируем агента и логируем операцию
     if agent_id:
         register_agent(agent_id)
-        log_agent_operation(agent_id, method, result)
+        success = bool(result.get("success", True))
+        log_agent_operation(agent_id, method, result, success=success, size=size)
+        broadcast_notification("porta/agentActivity", {
+            "agent_id": agent_id,
+            "method": method,
+            "success": success,
+            "timestamp": timestamp
+        })
+
+
+class ClosingStreamingResponse(StreamingResponse):
+    """StreamingResponse, который закрывает асинхронный генератор тела и при обрыве
+    соединения: его finally (аудит, остановка производителя) выполняется сразу,
+    а не при сборке мусора"""
+
+    async def stream_response(self, send):
+        try:
+            await super().stream_response(send)
+        finally:
+            await self.body_iterator.aclose()
 
 
 @app.get("/")
@@ -189,7 +836,14 @@ def read_root(request: Request):
                 "description": "Выполняет bash-команду",
                 "endpoint": "/run_bash",
                 "method": "POST",
-                "parameters": {"cmd": "string", "agent_id": "string (optional)"}
+                "parameters": {"cmd": "string", "agent_id": "string (optional)", "limits": "object (optional)"}
+            },
+            {
+                "name": "run_python",
+                "description": "Выполняет Python-код в тёплом воркере",
+                "endpoint": "/run_python",
+                "method": "POST",
+                "parameters": {"code": "string (optional)", "path": "string (optional)", "args": "array (optional)", "timeout": "int (optional)", "agent_id": "string (optional)"}
             },
             {
                 "name": "write_file",
@@ -212,6 +866,41 @@ def read_root(request: Request):
                 "method": "POST",
                 "parameters": {"path": "string", "include_hidden": "boolean", "agent_id": "string (optional)"}
             },
+            {
+                "name": "manifest",
+                "description": "Манифест дерева файлов: путь -> size, mtime, hash",
+                "endpoint": "/manifest",
+                "method": "POST",
+                "parameters": {"path": "string", "include_hidden": "boolean", "agent_id": "string (optional)"}
+            },
+            {
+                "name": "sync_signature",
+                "description": "Сигнатуры блоков файла для отправки дельты",
+                "endpoint": "/sync/signature",
+                "method": "POST",
+                "parameters": {"path": "string", "block_size": "int (optional)", "agent_id": "string (optional)"}
+            },
+            {
+                "name": "sync_delta",
+                "description": "Дельта файла относительно сигнатуры клиента",
+                "endpoint": "/sync/delta",
+                "method": "POST",
+                "parameters": {"path": "string", "block_size": "int (optional)", "blocks": "array", "agent_id": "string (optional)"}
+            },
+            {
+                "name": "sync_fetch",
+                "description": "Потоковая выдача байтов файла (full_transfer)",
+                "endpoint": "/sync/fetch",
+                "method": "POST",
+                "parameters": {"path": "string", "offset": "int (optional)", "length": "int (optional)", "agent_id": "string (optional)"}
+            },
+            {
+                "name": "sync_patch",
+                "description": "Применение дельты к файлу на сервере",
+                "endpoint": "/sync/patch",
+                "method": "POST",
+                "parameters": {"path": "string", "block_size": "int (optional)", "ops": "array", "hash": "string (optional)", "agent_id": "string (optional)"}
+            },
             {
                 "name": "agent_status",
                 "description": "Проверка работоспособности агента",
@@ -233,12 +922,26 @@ def read_root(request: Request):
                 "method": "POST",
                 "parameters": {"agent_id": "string", "limit": "int (optional)", "operation_type": "string (optional)"}
             },
+            {
+                "name": "agent_limits",
+                "description": "Лимиты ресурсов для команд агента",
+                "endpoint": "/agent/limits",
+                "method": "POST",
+                "parameters": {"agent_id": "string", "limits": "object (optional)", "clear": "boolean (optional)"}
+            },
+            {
+                "name": "agent_stats",
+                "description": "Агрегированная статистика агентов",
+                "endpoint": "/agent/stats",
+                "method": "POST",
+                "parameters": {"agent_id": "string (optional)", "operation_type": "string (optional)", "hours": "int (optional)"}
+            },
             {
                 "name": "agent_pipeline",
                 "description": "Выполнение последовательности команд",
                 "endpoint": "/agent/pipeline",
                 "method": "POST",
-                "parameters": {"agent_id": "string", "commands": "array", "timeout": "int (optional)"}
+                "parameters": {"agent_id": "string", "commands": "array", "timeout": "int (optional)", "limits": "object (optional)"}
             }
         ]
     }
@@ -255,17 +958,37 @@ def get_meta():
         "pid": os.getpid(),
         "port": 8111,  # Фактический порт работы
         "security": "X-PORTA-TOKEN authentication enabled",
+        "concurrency": concurrency_limiter.snapshot(),
         "endpoints": [
             "/",
             "/meta", 
+            "/healthz",
+            "/readyz",
             "/public_url",
             "/run_bash", 
+            "/run_python",
             "/write_file", 
             "/read_file", 
             "/list_dir", 
+            "/manifest",
+            "/sync/signature",
+            "/sync/delta",
+            "/sync/fetch",
+            "/sync/patch",
+            "/graph/query",
+            "/graph/neighborhood",
+            "/graph/search",
+            "/graph/update",
+            "/archive/download",
+            "/archive/upload",
+            "/ws",
+            "/watch",
+            "/debug/profile",
             "/agent/status",
             "/agent/list",
             "/agent/history",
+            "/agent/limits",
+            "/agent/stats",
             "/agent/pipeline"
         ],
         "timestamp": datetime.now().isoformat()
@@ -302,9 +1025,25 @@ def get_public_url():
         }
 
 
+class CommandLimits(BaseModel):
+    cpu_seconds: Optional[int] = None
+    memory_mb: Optional[int] = None
+    max_processes: Optional[int] = None
+
+
 class BashCommand(BaseModel):
     cmd: str
     agent_id: Optional[str] = None
+    limits: Optional[CommandLimits] = None
+
+
+class RunPythonRequest(BaseModel):
+    code: Optional[str] = None
+    path: Optional[str] = None
+    args: List[str] = []
+    timeout: int = 30
+    agent_id: Optional[str] = None
+    limits: Optional[CommandLimits] = None
 
 
 class FileWriteRequest(BaseModel):
@@ -341,64 +1080,753 @@ class AgentPipelineRequest(BaseModel):
     agent_id: str
     commands: List[str]
     timeout: Optional[int] = 30
+    limits: Optional[CommandLimits] = None
 
+class AgentStatsRequest(BaseModel):
+    agent_id: Optional[str] = None  # без agent_id — сводка по всем агентам
+    operation_type: Optional[str] = None
+    hours: int = 24
 
-@app.post("/agent/status")
-def agent_status(request: AgentStatusRequest):
-    """Проверка работоспособности агента"""
-    result = {
-        "status": "ok",
-        "agent_id": request.agent_id,
-        "timestamp": datetime.now().isoformat()
-    }
-    log_agent_call(request.agent_id, "agent_status", result)
-    return result
+class AgentLimitsRequest(BaseModel):
+    agent_id: str
+    limits: Optional[CommandLimits] = None  # без limits — только чтение
+    clear: bool = False
+
+class ManifestRequest(BaseModel):
+    path: str
+    include_hidden: bool = False
+    agent_id: Optional[str] = None
 
+class SyncBlock(BaseModel):
+    weak: int
+    strong: str
+    size: Optional[int] = None
 
-@app.post("/run_bash")
-def run_bash(command: BashCommand):
+class SyncSignatureRequest(BaseModel):
+    path: str
+    block_size: int = 8192
+    agent_id: Optional[str] = None
+
+class SyncDeltaRequest(BaseModel):
+    path: str
+    block_size: int = 8192
+    blocks: List[SyncBlock] = []
+    agent_id: Optional[str] = None
+
+class SyncFetchRequest(BaseModel):
+    path: str
+    offset: int = 0
+    length: Optional[int] = None  # по умолчанию до конца файла
+    agent_id: Optional[str] = None
+
+class SyncOp(BaseModel):
+    op: str  # "copy" или "data"
+    index: Optional[int] = None
+    count: int = 1
+    data: Optional[str] = None  # base64
+
+class SyncPatchRequest(BaseModel):
+    path: str
+    block_size: int = 8192
+    ops: List[SyncOp]
+    hash: Optional[str] = None  # ожидаемый sha256 результата
+    agent_id: Optional[str] = None
+
+class ArchiveDownloadRequest(BaseModel):
+    path: str
+    format: str = "tar.gz"  # tar.gz, tar, zip
+    include: List[str] = []
+    exclude: List[str] = []
+    include_hidden: bool = False
+    agent_id: Optional[str] = None
+
+class GraphQueryRequest(BaseModel):
+    project: str
+    type: Optional[str] = None
+    label: Optional[str] = None
+    keys: Optional[List[str]] = None
+    limit: int = 100
+    offset: int = 0
+    agent_id: Optional[str] = None
+
+class GraphNeighborhoodRequest(BaseModel):
+    project: str
+    node: str
+    depth: int = 1
+    direction: str = "both"  # out, in, both
+    relationship_type: Optional[str] = None
+    agent_id: Optional[str] = None
+
+class GraphSearchRequest(BaseModel):
+    project: str
+    query: str
+    type: Optional[str] = None
+    limit: int = 20
+    agent_id: Optional[str] = None
+
+class GraphOp(BaseModel):
+    op: str  # upsert_node, delete_node, upsert_edge, delete_edge
+    key: Optional[str] = None
+    source: Optional[str] = None
+    target: Optional[str] = None
+    attributes: Optional[Dict[str, Any]] = None
+
+class GraphUpdateRequest(BaseModel):
+    project: str
+    ops: List[GraphOp]
+    agent_id: Optional[str] = None
+
+
+# ===== Выполнение команд с учётом ресурсов =====
+
+def merge_limits(*limits: Optional[CommandLimits]) -> Optional[CommandLimits]:
+    """Объединяет лимиты, выбирая для каждого ресурса самое строгое значение"""
+    merged = {}
+    for item in limits:
+        if item is None:
+            continue
+        for field, value in item.model_dump().items():
+            if value is not None:
+                merged[field] = value if merged.get(field) is None else min(merged[field], value)
+    return CommandLimits(**merged) if merged else None
+
+
+def get_agent_limits(agent_id: Optional[str]) -> Optional[CommandLimits]:
+    """Возвращает лимиты агента из базы данных"""
+    if not agent_id:
+        return None
     try:
-        logger.info(f"Выполняется команда: {command.cmd}")
-        
-        # Выполняем команду с таймаутом 30 секунд
-        result = run(
-            command.cmd, 
-            shell=True, 
-            stdout=PIPE, 
-            stderr=PIPE, 
-            text=True,
-            timeout=30
+        conn = connect_agents_db()
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT cpu_seconds, memory_mb, max_processes FROM agent_limits WHERE agent_id = ?",
+            (agent_id,)
         )
-        
-        response = {
-            "stdout": result.stdout.strip(),
-            "stderr": result.stderr.strip(),
-            "exit_code": result.returncode,
-            "success": result.returncode == 0
-        }
-        
-        # Добавляем agent_id в ответ если он был передан
-        if command.agent_id:
-            response["agent_id"] = command.agent_id
-            log_agent_call(command.agent_id, "run_bash", response)
-        
-        return response
-        
-    except TimeoutExpired:
-        logger.error(f"Команда превысила таймаут: {command.cmd}")
-        raise HTTPException(status_code=408, detail="Команда превысила таймаут (30 секунд)")
-        
+        row = cursor.fetchone()
+        conn.close()
     except Exception as e:
-        logger.error(f"Ошибка выполнения команды: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Ошибка выполнения команды: {str(e)}")
+        logger.error(f"Ошибка чтения лимитов агента {agent_id}: {e}")
+        return None
+    if not row:
+        return None
+    return CommandLimits(cpu_seconds=row[0], memory_mb=row[1], max_processes=row[2])
 
 
-@app.post("/write_file")
-def write_file(req: FileWriteRequest):
+COMMAND_LAUNCHER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "porta_launcher.py")
+COMMAND_CANCEL_POLL_INTERVAL = 0.1
+COMMAND_START_TIMEOUT = 10      # Секунд на ответ форк-сервера о запуске команды
+
+# Событие отмены текущего запроса (выставляет $/cancelRequest в WebSocket JSON-RPC)
+command_cancel = contextvars.ContextVar("command_cancel", default=None)
+
+
+class CommandCancelled(Exception):
+    """Команда остановлена по запросу отмены"""
+
+
+# ===== Временные cgroup для max_processes =====
+
+PIDS_CGROUP_UNSET = object()
+pids_cgroup_root_path = PIDS_CGROUP_UNSET
+pids_cgroup_lock = threading.Lock()
+stale_pids_cgroups = set()
+
+
+def pids_cgroup_root() -> Optional[str]:
+    """Каталог, в котором создаются cgroup команд с pids.max, или None.
+
+    Берётся из PORTA_CGROUP_PIDS_ROOT (делегированная cgroup v2 с включённым
+    контроллером pids) либо из иерархии pids cgroup v1 текущего процесса.
+    """
+    global pids_cgroup_root_path
+    with pids_cgroup_lock:
+        if pids_cgroup_root_path is not PIDS_CGROUP_UNSET:
+            return pids_cgroup_root_path
+
+        root = os.getenv("PORTA_CGROUP_PIDS_ROOT")
+        if not root:
+            try:
+                with open("/proc/self/cgroup", "r", encoding="utf-8") as f:
+                    for line in f:
+                        _, controllers, path = line.rstrip("\n").split(":", 2)
+                        if "pids" in controllers.split(","):
+                            root = os.path.join("/sys/fs/cgroup/pids", path.lstrip("/"), "porta")
+                            break
+            except OSError:
+                pass
+        try:
+            if not root:
+                raise OSError("контроллер pids не найден")
+            os.makedirs(root, exist_ok=True)
+            if not os.access(root, os.W_OK):
+                raise OSError("нет прав на запись")
+        except OSError as e:
+            logger.warning(f"cgroup pids недоступны, max_processes не поддерживается: {e}")
+            root = None
+        pids_cgroup_root_path = root
+        return root
+
+
+def check_limits_supported(limits: Optional[CommandLimits]):
+    """Отклоняет лимиты, которые нельзя применить на этом сервере"""
+    if limits and limits.max_processes is not None:
+        if limits.max_processes < 1:
+            raise HTTPException(status_code=400, detail="max_processes должен быть положительным")
+        if not pids_cgroup_root():
+            raise HTTPException(
+                status_code=400,
+                detail="max_processes недоступен: нет cgroup pids (см. PORTA_CGROUP_PIDS_ROOT)"
+            )
+
+
+def create_pids_cgroup(max_processes: int) -> str:
+    """Создаёт cgroup для одной команды и ограничивает число процессов в ней"""
+    path = os.path.join(pids_cgroup_root(), f"cmd-{uuid.uuid4().hex[:12]}")
+    os.mkdir(path)
     try:
-        logger.info(f"Запись файла: {req.path}")
-        
-        # Простейшая защита от доступа вне текущей директории
+        with open(os.path.join(path, "pids.max"), "w") as f:
+            f.write(str(max_processes))
+    except OSError:
+        os.rmdir(path)
+        raise
+    return path
+
+
+def kill_pids_cgroup(path: str):
+    """Убивает все процессы cgroup, включая ушедшие в свою сессию"""
+    try:
+        with open(os.path.join(path, "cgroup.procs"), "r") as f:
+            pids = [int(line) for line in f if line.strip()]
+    except OSError:
+        return
+    for pid in pids:
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+
+def remove_pids_cgroup(path: str):
+    """Удаляет cgroup команды; занятые фоновыми процессами удаляются при следующих вызовах"""
+    with pids_cgroup_lock:
+        stale_pids_cgroups.add(path)
+        for stale in list(stale_pids_cgroups):
+            try:
+                os.rmdir(stale)
+            except FileNotFoundError:
+                pass
+            except OSError:
+                continue
+            stale_pids_cgroups.discard(stale)
+
+
+# ===== Форк-сервер shell-команд =====
+
+class CommandLauncher:
+    """Процесс porta_launcher.py, форкающий shell-команды по запросу сервера"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = {}  # request_id -> {"started": Event, "finished": Event, "pid": int, "result": dict}
+        self.sock, child_sock = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        try:
+            self.process = Popen(
+                [sys.executable, "-S", COMMAND_LAUNCHER_SCRIPT, str(child_sock.fileno())],
+                stdin=DEVNULL,
+                start_new_session=True,
+                pass_fds=(child_sock.fileno(),)
+            )
+        finally:
+            child_sock.close()
+        threading.Thread(target=self.read_responses, name=f"porta-command-reader-{self.process.pid}", daemon=True).start()
+
+    def alive(self) -> bool:
+        return self.process.poll() is None
+
+    def read_responses(self):
+        while True:
+            try:
+                data = self.sock.recv(65536)
+            except OSError:
+                break
+            if not data:
+                break
+            message = json.loads(data)
+            with self.lock:
+                waiter = self.pending.get(message.get("id"))
+            if not waiter:
+                continue
+            if "pid" in message:
+                waiter["pid"] = message["pid"]
+                waiter["started"].set()
+            else:
+                with self.lock:
+                    self.pending.pop(message["id"], None)
+                waiter["result"] = message
+                waiter["started"].set()
+                waiter["finished"].set()
+
+        # Форк-сервер завершился — будим всех ожидающих
+        with self.lock:
+            waiters = list(self.pending.values())
+            self.pending.clear()
+        for waiter in waiters:
+            waiter["started"].set()
+            waiter["finished"].set()
+
+    def spawn(self, request: Dict[str, Any], stdout_fd: int, stderr_fd: int) -> Dict[str, Any]:
+        """Запускает команду и возвращает ожидание с её pid; завершение — через waiter["finished"]"""
+        waiter = {"started": threading.Event(), "finished": threading.Event(), "pid": None, "result": None}
+        with self.lock:
+            self.pending[request["id"]] = waiter
+            try:
+                socket.send_fds(self.sock, [json.dumps(request).encode("utf-8")], [stdout_fd, stderr_fd])
+            except OSError:
+                self.pending.pop(request["id"], None)
+                raise
+        waiter["started"].wait(COMMAND_START_TIMEOUT)
+        if waiter["pid"] is None:
+            with self.lock:
+                self.pending.pop(request["id"], None)
+            error = (waiter["result"] or {}).get("error", "форк-сервер не ответил")
+            raise RuntimeError(f"Не удалось запустить команду: {error}")
+        return waiter
+
+    def stop(self):
+        try:
+            self.sock.close()
+            self.process.wait(timeout=5)
+        except Exception:
+            self.process.kill()
+
+
+command_launcher = None
+command_launcher_lock = threading.Lock()
+
+
+def get_command_launcher() -> CommandLauncher:
+    """Возвращает работающий форк-сервер команд, перезапуская упавший"""
+    global command_launcher
+    with command_launcher_lock:
+        if command_launcher is None or not command_launcher.alive():
+            if command_launcher is not None:
+                logger.warning(f"Форк-сервер команд {command_launcher.process.pid} завершился, перезапуск")
+            command_launcher = CommandLauncher()
+        return command_launcher
+
+
+def stop_command_launcher():
+    with command_launcher_lock:
+        if command_launcher is not None:
+            command_launcher.stop()
+
+
+def execute_command(cmd: str, timeout: Optional[float], limits: Optional[CommandLimits] = None) -> Dict[str, Any]:
+    """Выполняет shell-команду и возвращает вывод, код возврата и потреблённые ресурсы.
+
+    Команду форкает долгоживущий porta_launcher.py: он выставляет rlimits, помещает
+    команду в cgroup с pids.max и сообщает rusage её дерева процессов. Таймаут
+    покрывает и ожидание процесса, и чтение вывода, поэтому фоновый потомок,
+    держащий stdout, не продлевает запрос. При превышении таймаута вся сессия
+    убивается и выбрасывается TimeoutExpired, при отмене через command_cancel —
+    CommandCancelled.
+    """
+    cancel = command_cancel.get()
+    if cancel is not None and cancel.is_set():
+        raise CommandCancelled(cmd)
+
+    started = time.time()
+    deadline = started + timeout if timeout else None
+    limit_values = {k: v for k, v in limits.model_dump().items() if v is not None} if limits else {}
+    cgroup = create_pids_cgroup(limits.max_processes) if limits and limits.max_processes is not None else None
+
+    stdout_r, stdout_w = os.pipe()
+    stderr_r, stderr_w = os.pipe()
+    try:
+        waiter = get_command_launcher().spawn({
+            "id": uuid.uuid4().hex,
+            "cmd": cmd,
+            "cwd": os.getcwd(),
+            "limits": limit_values,
+            "cgroup": cgroup
+        }, stdout_w, stderr_w)
+    except Exception:
+        os.close(stdout_r)
+        os.close(stderr_r)
+        if cgroup:
+            remove_pids_cgroup(cgroup)
+        raise
+    finally:
+        os.close(stdout_w)
+        os.close(stderr_w)
+
+    chunks = {"stdout": [], "stderr": []}
+    selector = selectors.DefaultSelector()
+    selector.register(stdout_r, selectors.EVENT_READ, "stdout")
+    selector.register(stderr_r, selectors.EVENT_READ, "stderr")
+
+    try:
+        while selector.get_map() or not waiter["finished"].is_set():
+            remaining = deadline - time.time() if deadline else None
+            expired = remaining is not None and remaining <= 0
+            if expired or (cancel is not None and cancel.is_set()):
+                try:
+                    os.killpg(waiter["pid"], signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+                if cgroup:
+                    kill_pids_cgroup(cgroup)
+                waiter["finished"].wait(1)
+                if expired:
+                    raise TimeoutExpired(cmd, timeout)
+                raise CommandCancelled(cmd)
+            if cancel is not None:
+                remaining = min(remaining, COMMAND_CANCEL_POLL_INTERVAL) if remaining is not None else COMMAND_CANCEL_POLL_INTERVAL
+            if not selector.get_map():
+                # Вывод закрыт, ждём отчёт форк-сервера о завершении
+                waiter["finished"].wait(remaining)
+                continue
+            for key, _ in selector.select(remaining):
+                chunk = os.read(key.fd, 65536)
+                if chunk:
+                    chunks[key.data].append(chunk)
+                else:
+                    selector.unregister(key.fd)
+    finally:
+        selector.close()
+        os.close(stdout_r)
+        os.close(stderr_r)
+        if cgroup:
+            remove_pids_cgroup(cgroup)
+
+    report = waiter["result"]
+    if report is None:
+        raise RuntimeError("Форк-сервер команд завершился до отчёта о команде")
+
+    return {
+        "stdout": b"".join(chunks["stdout"]).decode("utf-8", errors="replace"),
+        "stderr": b"".join(chunks["stderr"]).decode("utf-8", errors="replace"),
+        "returncode": report["returncode"],
+        "resources": {
+            "wall_time": round(time.time() - started, 4),
+            "user_cpu": round(report["user_cpu"], 4),
+            "sys_cpu": round(report["sys_cpu"], 4),
+            "max_rss_kb": report["max_rss_kb"],
+            # Блочный ввод-вывод в 512-байтовых блоках, без чтений из page cache
+            "read_bytes": report["read_bytes"],
+            "write_bytes": report["write_bytes"]
+        }
+    }
+
+
+@app.post("/agent/status")
+def agent_status(request: AgentStatusRequest):
+    """Проверка работоспособности агента"""
+    result = {
+        "status": "ok",
+        "agent_id": request.agent_id,
+        "timestamp": datetime.now().isoformat()
+    }
+    log_agent_call(request.agent_id, "agent_status", result)
+    return result
+
+
+@app.post("/run_bash")
+def run_bash(command: BashCommand):
+    try:
+        logger.info(f"Выполняется команда: {command.cmd}")
+        
+        # Выполняем команду с таймаутом 30 секунд и лимитами запроса/агента
+        limits = merge_limits(command.limits, get_agent_limits(command.agent_id))
+        check_limits_supported(limits)
+        result = execute_command(command.cmd, timeout=30, limits=limits)
+        
+        response = {
+            "stdout": result["stdout"].strip(),
+            "stderr": result["stderr"].strip(),
+            "exit_code": result["returncode"],
+            "success": result["returncode"] == 0,
+            "resources": result["resources"]
+        }
+        
+        # Добавляем agent_id в ответ если он был передан
+        if command.agent_id:
+            response["agent_id"] = command.agent_id
+            log_agent_call(command.agent_id, "run_bash", response,
+                           size=payload_size(command.cmd, result["stdout"], result["stderr"]))
+        
+        return response
+        
+    except TimeoutExpired:
+        logger.error(f"Команда превысила таймаут: {command.cmd}")
+        raise HTTPException(status_code=408, detail="Команда превысила таймаут (30 секунд)")
+
+    except CommandCancelled:
+        logger.info(f"Команда отменена: {command.cmd}")
+        raise HTTPException(status_code=409, detail="Команда отменена")
+
+    except HTTPException:
+        raise
+        
+    except Exception as e:
+        logger.error(f"Ошибка выполнения команды: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Ошибка выполнения команды: {str(e)}")
+
+
+# ===== Пул тёплых Python-воркеров =====
+
+PYTHON_WORKERS = int(os.getenv("PORTA_PYTHON_WORKERS", 2))
+PYTHON_PRELOAD = [m for m in os.getenv("PORTA_PYTHON_PRELOAD", "").split(",") if m.strip()]
+PYTHON_MAX_TIMEOUT = 600        # Секунд; без таймаута форк сниппета жил бы бесконечно
+PYTHON_WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "porta_worker.py")
+
+
+class PythonWorker:
+    """Процесс porta_worker.py с предзагруженными модулями, форкающий сниппеты"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = {}  # request_id -> {"event": Event, "result": dict}
+        self.info = {}
+        self.ready = threading.Event()
+        self.process = Popen(
+            [sys.executable, PYTHON_WORKER_SCRIPT, *PYTHON_PRELOAD],
+            stdin=PIPE,
+            stdout=PIPE,
+            start_new_session=True
+        )
+        threading.Thread(target=self.read_responses, name=f"porta-python-reader-{self.process.pid}", daemon=True).start()
+
+    def alive(self) -> bool:
+        return self.process.poll() is None
+
+    def read_responses(self):
+        for line in self.process.stdout:
+            try:
+                message = json.loads(line)
+            except ValueError:
+                continue
+            if message.get("ready"):
+                self.info = message
+                if message.get("failed"):
+                    logger.warning(f"Не удалось предзагрузить модули: {message['failed']}")
+                self.ready.set()
+                continue
+            with self.lock:
+                waiter = self.pending.pop(message.get("id"), None)
+            if waiter:
+                waiter["result"] = message
+                waiter["event"].set()
+
+        # Воркер завершился — будим всех ожидающих
+        self.ready.set()
+        with self.lock:
+            waiters = list(self.pending.values())
+            self.pending.clear()
+        for waiter in waiters:
+            waiter["event"].set()
+
+    def send(self, message: Dict[str, Any]):
+        self.process.stdin.write((json.dumps(message) + "\n").encode("utf-8"))
+        self.process.stdin.flush()
+
+    def submit(self, request: Dict[str, Any], wait_timeout: float,
+               cancel: Optional[threading.Event] = None) -> Optional[Dict[str, Any]]:
+        """Отправляет запрос и ждёт ответа; при выставленном cancel воркер убивает сниппет"""
+        waiter = {"event": threading.Event(), "result": None}
+        with self.lock:
+            self.pending[request["id"]] = waiter
+            self.send(request)
+        deadline = time.monotonic() + wait_timeout
+        killed = False
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            if cancel is not None and not killed:
+                remaining = min(remaining, COMMAND_CANCEL_POLL_INTERVAL)
+            if waiter["event"].wait(remaining):
+                break
+            if cancel is not None and cancel.is_set() and not killed:
+                killed = True
+                with self.lock:
+                    self.send({"kill": request["id"]})
+        with self.lock:
+            self.pending.pop(request["id"], None)
+        return waiter["result"]
+
+    def stop(self):
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=5)
+        except Exception:
+            self.process.kill()
+
+
+class PythonWorkerPool:
+    """Пул тёплых воркеров; упавшие воркеры перезапускаются при следующем запросе"""
+
+    def __init__(self, size: int):
+        self.size = max(1, size)
+        self.workers = []
+        self.lock = threading.Lock()
+        self.counter = 0
+
+    def start(self):
+        with self.lock:
+            self.workers = [w for w in self.workers if w.alive()]
+            while len(self.workers) < self.size:
+                self.workers.append(PythonWorker())
+        for worker in list(self.workers):
+            worker.ready.wait(60)
+
+    def pick(self) -> PythonWorker:
+        with self.lock:
+            self.counter += 1
+            for _ in range(self.size):
+                if len(self.workers) < self.size:
+                    self.workers.append(PythonWorker())
+                worker = self.workers[self.counter % len(self.workers)]
+                if worker.alive():
+                    return worker
+                logger.warning(f"Python-воркер {worker.process.pid} завершился, перезапуск")
+                self.workers.remove(worker)
+            worker = PythonWorker()
+            self.workers.append(worker)
+            return worker
+
+    def execute(self, code: Optional[str], path: Optional[str], args: List[str], timeout: int,
+                limits: Optional[CommandLimits] = None) -> Dict[str, Any]:
+        """Выполняет сниппет или скрипт в форке тёплого воркера"""
+        cancel = command_cancel.get()
+        if cancel is not None and cancel.is_set():
+            raise CommandCancelled(code or path)
+        worker = self.pick()
+        worker.ready.wait(60)
+
+        cgroup = create_pids_cgroup(limits.max_processes) if limits and limits.max_processes is not None else None
+        stdout_fd, stdout_path = tempfile.mkstemp(prefix="porta-py-", suffix=".out")
+        stderr_fd, stderr_path = tempfile.mkstemp(prefix="porta-py-", suffix=".err")
+        os.close(stdout_fd)
+        os.close(stderr_fd)
+        result = None
+        try:
+            result = worker.submit({
+                "id": uuid.uuid4().hex,
+                "code": code,
+                "path": path,
+                "args": args,
+                "cwd": os.getcwd(),
+                "timeout": timeout,
+                "limits": limits.model_dump() if limits else None,
+                "cgroup": cgroup,
+                "stdout_path": stdout_path,
+                "stderr_path": stderr_path
+            }, wait_timeout=timeout + 10, cancel=cancel)
+
+            if cancel is not None and cancel.is_set():
+                raise CommandCancelled(code or path)
+            if result is None:
+                raise RuntimeError("Python-воркер не ответил")
+            if result.get("timed_out"):
+                raise TimeoutExpired(code or path, timeout)
+
+            with open(stdout_path, "r", encoding="utf-8", errors="replace") as f:
+                stdout = f.read()
+            with open(stderr_path, "r", encoding="utf-8", errors="replace") as f:
+                stderr = f.read()
+
+            return {
+                "stdout": stdout,
+                "stderr": stderr,
+                "returncode": result["returncode"],
+                "resources": result["resources"],
+                "worker_pid": worker.process.pid
+            }
+        finally:
+            os.remove(stdout_path)
+            os.remove(stderr_path)
+            if cgroup:
+                if result is None or result.get("timed_out") or (cancel is not None and cancel.is_set()):
+                    kill_pids_cgroup(cgroup)
+                remove_pids_cgroup(cgroup)
+
+    def status(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                "size": self.size,
+                "alive": sum(1 for w in self.workers if w.alive()),
+                "preload": PYTHON_PRELOAD
+            }
+
+    def stop(self):
+        with self.lock:
+            workers, self.workers = self.workers, []
+        for worker in workers:
+            worker.stop()
+
+
+python_pool = PythonWorkerPool(PYTHON_WORKERS)
+
+
+@app.post("/run_python")
+def run_python(req: RunPythonRequest):
+    """Выполняет Python-код в форке тёплого воркера с предзагруженными модулями"""
+    try:
+        if bool(req.code) == bool(req.path):
+            raise HTTPException(status_code=400, detail="Нужно указать либо code, либо path")
+        if not 0 < req.timeout <= PYTHON_MAX_TIMEOUT:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Таймаут должен быть от 1 до {PYTHON_MAX_TIMEOUT} секунд"
+            )
+        if req.path and is_forbidden_path(req.path):
+            logger.error(f"Недопустимый путь: {req.path}")
+            raise HTTPException(status_code=400, detail="Недопустимый путь")
+
+        logger.info(f"Выполняется Python-{'скрипт ' + req.path if req.path else 'сниппет'}")
+
+        limits = merge_limits(req.limits, get_agent_limits(req.agent_id))
+        check_limits_supported(limits)
+        result = python_pool.execute(req.code, req.path, req.args, req.timeout, limits)
+
+        response = {
+            "stdout": result["stdout"].strip(),
+            "stderr": result["stderr"].strip(),
+            "exit_code": result["returncode"],
+            "success": result["returncode"] == 0,
+            "resources": result["resources"]
+        }
+
+        if req.agent_id:
+            response["agent_id"] = req.agent_id
+            log_agent_call(req.agent_id, "run_python", response,
+                           size=payload_size(req.code, result["stdout"], result["stderr"]))
+
+        return response
+
+    except TimeoutExpired:
+        logger.error(f"Python-код превысил таймаут ({req.timeout} секунд)")
+        raise HTTPException(status_code=408, detail=f"Python-код превысил таймаут ({req.timeout} секунд)")
+
+    except CommandCancelled:
+        logger.info("Выполнение Python-кода отменено")
+        raise HTTPException(status_code=409, detail="Выполнение отменено")
+
+    except HTTPException:
+        raise
+
+    except Exception as e:
+        logger.error(f"Ошибка выполнения Python-кода: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Ошибка выполнения Python-кода: {str(e)}")
+
+
+@app.post("/write_file")
+def write_file(req: FileWriteRequest):
+    try:
+        logger.info(f"Запись файла: {req.path}")
+        
+        # Простейшая защита от доступа вне текущей директории
         if ".." in req.path or req.path.startswith("/etc") or req.path.startswith("/dev"):
             logger.error(f"Недопустимый путь: {req.path}")
             raise HTTPException(status_code=400, detail="Недопустимый путь")
@@ -424,7 +1852,7 @@ def write_file(req: FileWriteRequest):
         # Добавляем agent_id в ответ если он был передан
         if req.agent_id:
             response["agent_id"] = req.agent_id
-            log_agent_call(req.agent_id, "write_file", response)
+            log_agent_call(req.agent_id, "write_file", response, size=payload_size(req.content))
         
         return response
         
@@ -476,7 +1904,7 @@ def read_file(req: FileReadRequest):
             # Добавляем agent_id в ответ если он был передан
             if req.agent_id:
                 response["agent_id"] = req.agent_id
-                log_agent_call(req.agent_id, "read_file", response)
+                log_agent_call(req.agent_id, "read_file", response, size=payload_size(content))
             
             return response
             
@@ -549,7 +1977,7 @@ def list_dir(req: DirListRequest):
             # Добавляем agent_id в ответ если он был передан
             if req.agent_id:
                 response["agent_id"] = req.agent_id
-                log_agent_call(req.agent_id, "list_dir", response)
+                log_agent_call(req.agent_id, "list_dir", response, size=payload_size(json.dumps(entries)))
             
             return response
             
@@ -566,59 +1994,531 @@ def list_dir(req: DirListRequest):
         raise HTTPException(status_code=500, detail=f"Ошибка чтения папки: {str(e)}")
 
 
-@app.post("/agent/list")
-def agent_list(request: AgentListRequest):
-    """Возвращает список зарегистрированных агентов"""
+# ===== Дельта-синхронизация файлов (по мотивам rsync) =====
+
+# Кэш хэшей файлов: full_path -> (size, mtime_ns, sha256)
+FILE_HASH_CACHE_LIMIT = 100000
+file_hash_cache = OrderedDict()
+file_hash_lock = threading.Lock()
+
+SYNC_MIN_BLOCK_SIZE = 512
+SYNC_MAX_BLOCK_SIZE = 1024 * 1024
+SYNC_DELTA_MAX_SIZE = int(os.getenv("PORTA_SYNC_DELTA_MAX_SIZE", 256 * 1024 * 1024))  # Больше — файл целиком
+SYNC_LITERAL_MAX_SIZE = int(os.getenv("PORTA_SYNC_LITERAL_MAX_SIZE", 32 * 1024 * 1024))  # Больше литералов — тоже
+SYNC_RESYNC_BLOCKS = 4               # Окно побайтового поиска, в блоках; повторяется по ходу литерала
+SYNC_FETCH_CHUNK = 1024 * 1024
+SYNC_ROLL_BUDGET = 1024 * 1024       # Всего байт побайтового поиска на один запрос дельты
+
+
+def file_sha256(full_path: str, size: int, mtime_ns: int) -> str:
+    """Возвращает sha256 файла, пересчитывая его только при изменении size/mtime"""
+    with file_hash_lock:
+        cached = file_hash_cache.get(full_path)
+        if cached and cached[0] == size and cached[1] == mtime_ns:
+            file_hash_cache.move_to_end(full_path)
+            return cached[2]
+
+    digest = hashlib.sha256()
+    with open(full_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    file_hash = digest.hexdigest()
+
+    with file_hash_lock:
+        file_hash_cache[full_path] = (size, mtime_ns, file_hash)
+        file_hash_cache.move_to_end(full_path)
+        while len(file_hash_cache) > FILE_HASH_CACHE_LIMIT:
+            file_hash_cache.popitem(last=False)
+    return file_hash
+
+
+def build_manifest(root: str, include_hidden: bool = False) -> Dict[str, Dict[str, Any]]:
+    """Строит манифест дерева: относительный путь -> size, mtime, hash"""
+    manifest = {}
+    stack = [root]
+    while stack:
+        current = stack.pop()
+        try:
+            with os.scandir(current) as it:
+                for entry in it:
+                    if not include_hidden and entry.name.startswith('.'):
+                        continue
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        elif entry.is_file(follow_symlinks=False):
+                            st = entry.stat(follow_symlinks=False)
+                            rel_path = os.path.relpath(entry.path, root)
+                            manifest[rel_path] = {
+                                "size": st.st_size,
+                                "mtime": st.st_mtime,
+                                "hash": file_sha256(entry.path, st.st_size, st.st_mtime_ns)
+                            }
+                    except OSError as e:
+                        logger.warning(f"Пропуск {entry.path} при построении манифеста: {e}")
+        except PermissionError:
+            logger.warning(f"Нет прав на чтение папки: {current}")
+    return manifest
+
+
+def weak_checksum(block: bytes):
+    """Слабая контрольная сумма rsync: возвращает (a, b)"""
+    a = sum(block) & 0xffff
+    # sum((len - i) * x_i) равна сумме префиксных сумм, а accumulate считается в C
+    b = sum(itertools.accumulate(block)) & 0xffff
+    return a, b
+
+
+def strong_checksum(block: bytes) -> str:
+    """Сильная контрольная сумма блока"""
+    return hashlib.blake2b(block, digest_size=16).hexdigest()
+
+
+def file_signature(full_path: str, block_size: int) -> List[Dict[str, Any]]:
+    """Считает сигнатуры блоков файла"""
+    blocks = []
+    with open(full_path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            a, b = weak_checksum(block)
+            blocks.append({"weak": a | (b << 16), "strong": strong_checksum(block), "size": len(block)})
+    return blocks
+
+
+def compute_delta(data, block_size: int, blocks: List[SyncBlock]) -> List[Dict[str, Any]]:
+    """Строит дельту data относительно сигнатуры блоков получателя.
+
+    data — bytes или mmap файла. Сначала проверяются позиции, выровненные по блокам
+    от последнего совпадения: сильный хэш считается в C и находит правки на месте и
+    дописывание. После промаха включается побайтовый скользящий поиск на окне из
+    SYNC_RESYNC_BLOCKS блоков; пока литерал продолжается, окна идут подряд, так что
+    сдвиг после длинной правки тоже находится. Всего побайтовый поиск ограничен
+    SYNC_ROLL_BUDGET байтами на запрос.
+
+    Литералы возвращаются диапазонами {"op": "data", "start", "end"} — кодирует их
+    вызывающий, когда убедится, что объём допустим.
+    """
+    weak_table = {}
+    strong_table = {}
+    tail_block = None
+    for index, block in enumerate(blocks):
+        if block.size is not None and block.size != block_size:
+            # Короткий последний блок не участвует в поиске
+            tail_block = (index, block)
+            continue
+        weak_table.setdefault(block.weak, {}).setdefault(block.strong, index)
+        strong_table.setdefault(block.strong, index)
+
+    ops = []
+
+    def emit_data(start: int, end: int):
+        if end > start:
+            ops.append({"op": "data", "start": start, "end": end})
+
+    def emit_copy(index: int):
+        last = ops[-1] if ops else None
+        if last and last["op"] == "copy" and last["index"] + last["count"] == index:
+            last["count"] += 1
+        else:
+            ops.append({"op": "copy", "index": index, "count": 1})
+
+    def roll_search(start: int, stop: int) -> Optional[tuple]:
+        """Ищет совпадающий блок на смещениях (start, stop]"""
+        a, b = weak_checksum(data[start:start + block_size])
+        for i in range(start, stop):
+            out_byte = data[i]
+            in_byte = data[i + block_size]
+            a = (a - out_byte + in_byte) & 0xffff
+            b = (b - block_size * out_byte + a) & 0xffff
+            candidates = weak_table.get(a | (b << 16))
+            if candidates:
+                index = candidates.get(strong_checksum(data[i + 1:i + 1 + block_size]))
+                if index is not None:
+                    return i + 1, index
+        return None
+
+    length = len(data)
+    literal_start = 0
+    i = 0
+    roll_budget = SYNC_ROLL_BUDGET
+    search_from = 0  # Смещения до этой позиции уже просмотрены побайтово
+    if strong_table:
+        while i + block_size <= length:
+            index = strong_table.get(strong_checksum(data[i:i + block_size]))
+            if index is None and i >= search_from and roll_budget > 0:
+                stop = min(i + SYNC_RESYNC_BLOCKS * block_size, length - block_size, i + roll_budget)
+                search_from = stop
+                roll_budget -= stop - i
+                found = roll_search(i, stop) if stop > i else None
+                if found:
+                    i, index = found
+            if index is None:
+                i += block_size
+                continue
+            emit_data(literal_start, i)
+            emit_copy(index)
+            i += block_size
+            literal_start = search_from = i
+
+    tail = data[literal_start:]
+    if tail_block and tail and len(tail) == tail_block[1].size and strong_checksum(tail) == tail_block[1].strong:
+        emit_copy(tail_block[0])
+    else:
+        emit_data(literal_start, length)
+    return ops
+
+
+def validate_block_size(block_size: int):
+    """Проверяет допустимость размера блока"""
+    if not SYNC_MIN_BLOCK_SIZE <= block_size <= SYNC_MAX_BLOCK_SIZE:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Размер блока должен быть от {SYNC_MIN_BLOCK_SIZE} до {SYNC_MAX_BLOCK_SIZE} байт"
+        )
+
+
+def resolve_sync_file(path: str, must_exist: bool = True) -> str:
+    """Проверяет путь и возвращает абсолютный путь к файлу"""
+    if is_forbidden_path(path):
+        logger.error(f"Недопустимый путь: {path}")
+        raise HTTPException(status_code=400, detail="Недопустимый путь")
+
+    full_path = os.path.abspath(path)
+    if must_exist and not os.path.exists(full_path):
+        logger.error(f"Файл не существует: {full_path}")
+        raise HTTPException(status_code=404, detail="Файл не найден")
+    if os.path.exists(full_path) and not os.path.isfile(full_path):
+        logger.error(f"Путь не является файлом: {full_path}")
+        raise HTTPException(status_code=400, detail="Указанный путь не является файлом")
+    return full_path
+
+
+@app.post("/manifest")
+def manifest(req: ManifestRequest):
+    """Возвращает манифест дерева: путь -> (size, mtime, hash)"""
     try:
-        conn = sqlite3.connect(AGENTS_DB)
-        cursor = conn.cursor()
-        
-        # Формируем запрос с фильтрами
-        query = "SELECT id, name, created_at, last_seen, total_operations, status FROM agents"
-        params = []
-        
-        if request.status:
-            query += " WHERE status = ?"
-            params.append(request.status)
-        
-        query += " ORDER BY last_seen DESC LIMIT ? OFFSET ?"
-        params.extend([request.limit, request.offset])
-        
-        cursor.execute(query, params)
-        agents = []
-        
-        for row in cursor.fetchall():
-            agents.append({
-                "id": row[0],
-                "name": row[1],
-                "created_at": row[2],
-                "last_seen": row[3],
-                "total_operations": row[4],
-                "status": row[5]
-            })
-        
-        conn.close()
-        
-        result = {
+        logger.info(f"Построение манифеста: {req.path}")
+
+        if is_forbidden_path(req.path):
+            logger.error(f"Недопустимый путь: {req.path}")
+            raise HTTPException(status_code=400, detail="Недопустимый путь")
+
+        full_path = os.path.abspath(req.path)
+
+        if not os.path.exists(full_path):
+            logger.error(f"Папка не существует: {full_path}")
+            raise HTTPException(status_code=404, detail="Папка не найдена")
+
+        if not os.path.isdir(full_path):
+            logger.error(f"Путь не является папкой: {full_path}")
+            raise HTTPException(status_code=400, detail="Указанный путь не является папкой")
+
+        entries = build_manifest(full_path, req.include_hidden)
+
+        response = {
             "success": True,
-            "agents": agents,
-            "total": len(agents),
-            "limit": request.limit,
-            "offset": request.offset
+            "path": full_path,
+            "entries": entries,
+            "total_files": len(entries),
+            "total_size": sum(e["size"] for e in entries.values())
         }
-        
-        return result
-        
+
+        if req.agent_id:
+            response["agent_id"] = req.agent_id
+            # В аудит пишем только сводку, без самого манифеста
+            log_agent_call(req.agent_id, "manifest", {
+                "success": True,
+                "path": full_path,
+                "total_files": response["total_files"],
+                "total_size": response["total_size"]
+            }, size=payload_size(json.dumps(entries)))
+
+        return response
+
+    except HTTPException:
+        raise
+
     except Exception as e:
-        logger.error(f"Ошибка получения списка агентов: {e}")
-        raise HTTPException(status_code=500, detail=f"Ошибка получения списка агентов: {str(e)}")
+        logger.error(f"Ошибка построения манифеста: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Ошибка построения манифеста: {str(e)}")
+
+
+@app.post("/sync/signature")
+def sync_signature(req: SyncSignatureRequest):
+    """Возвращает сигнатуры блоков файла для отправки дельты на сервер"""
+    try:
+        validate_block_size(req.block_size)
+        full_path = resolve_sync_file(req.path)
+
+        st = os.stat(full_path)
+        response = {
+            "success": True,
+            "path": full_path,
+            "size": st.st_size,
+            "hash": file_sha256(full_path, st.st_size, st.st_mtime_ns),
+            "block_size": req.block_size,
+            "blocks": file_signature(full_path, req.block_size)
+        }
+
+        if req.agent_id:
+            response["agent_id"] = req.agent_id
+            log_agent_call(req.agent_id, "sync_signature", {
+                "success": True,
+                "path": full_path,
+                "size": st.st_size,
+                "blocks": len(response["blocks"])
+            }, size=payload_size(json.dumps(response["blocks"])))
+
+        return response
+
+    except HTTPException:
+        raise
+
+    except Exception as e:
+        logger.error(f"Ошибка расчёта сигнатуры: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Ошибка расчёта сигнатуры: {str(e)}")
+
+
+@app.post("/sync/delta")
+def sync_delta(req: SyncDeltaRequest):
+    """Возвращает дельту файла сервера относительно сигнатуры копии клиента"""
+    try:
+        validate_block_size(req.block_size)
+        full_path = resolve_sync_file(req.path)
+
+        st = os.stat(full_path)
+        size = st.st_size
+        ops = None  # None — дельты нет, клиент скачивает файл через /sync/fetch
+        literal_bytes = size
+        if size > SYNC_DELTA_MAX_SIZE:
+            # Дельта такого файла дороже передачи целиком
+            logger.info(f"Файл больше {SYNC_DELTA_MAX_SIZE} байт, дельта не считается: {full_path}")
+            file_hash = file_sha256(full_path, size, st.st_mtime_ns)
+        else:
+            # mmap вместо чтения в память: страницы подгружаются и вытесняются ядром
+            with open(full_path, "rb") as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+            try:
+                file_hash = hashlib.sha256(data).hexdigest()
+                delta = compute_delta(data, req.block_size, req.blocks)
+                delta_literal_bytes = sum(op["end"] - op["start"] for op in delta if op["op"] == "data")
+                if delta_literal_bytes > SYNC_LITERAL_MAX_SIZE:
+                    # Литералы не кладём в JSON целиком: /sync/fetch отдаёт файл потоком
+                    logger.info(f"Литералов дельты больше {SYNC_LITERAL_MAX_SIZE} байт, файл целиком: {full_path}")
+                else:
+                    for op in delta:
+                        if op["op"] == "data":
+                            start, end = op.pop("start"), op.pop("end")
+                            op["data"] = base64.b64encode(data[start:end]).decode("ascii")
+                    ops = delta
+                    literal_bytes = delta_literal_bytes
+            finally:
+                if size:
+                    data.close()
+
+        response = {
+            "success": True,
+            "path": full_path,
+            "size": size,
+            "hash": file_hash,
+            "block_size": req.block_size,
+            "full_transfer": ops is None,
+            "ops": ops or [],
+            "literal_bytes": literal_bytes
+        }
+
+        if req.agent_id:
+            response["agent_id"] = req.agent_id
+            log_agent_call(req.agent_id, "sync_delta", {
+                "success": True,
+                "path": full_path,
+                "size": response["size"],
+                "literal_bytes": literal_bytes
+            }, size=payload_size(json.dumps([block.model_dump() for block in req.blocks])) + literal_bytes)
+
+        return response
+
+    except HTTPException:
+        raise
+
+    except Exception as e:
+        logger.error(f"Ошибка расчёта дельты: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Ошибка расчёта дельты: {str(e)}")
+
+
+@app.post("/sync/fetch")
+def sync_fetch(req: SyncFetchRequest):
+    """Потоково отдаёт байты файла — для full_transfer из /sync/delta и докачки"""
+    full_path = resolve_sync_file(req.path)
+    if req.offset < 0 or (req.length is not None and req.length < 0):
+        raise HTTPException(status_code=400, detail="offset и length не могут быть отрицательными")
+
+    st = os.stat(full_path)
+    offset = min(req.offset, st.st_size)
+    length = st.st_size - offset if req.length is None else min(req.length, st.st_size - offset)
+    logger.info(f"Выдача файла: {full_path} ({offset}+{length})")
+
+    async def stream():
+        sent = 0
+        error = None
+        try:
+            with open(full_path, "rb") as f:
+                f.seek(offset)
+                while sent < length:
+                    chunk = await run_in_threadpool(f.read, min(SYNC_FETCH_CHUNK, length - sent))
+                    if not chunk:
+                        break
+                    sent += len(chunk)
+                    yield chunk
+        except Exception as e:
+            error = str(e)
+            logger.error(f"Ошибка выдачи файла {full_path}: {e}")
+            raise
+        finally:
+            if req.agent_id:
+                details = {
+                    "success": error is None and sent == length,
+                    "path": full_path,
+                    "offset": offset,
+                    "size": sent,
+                    **({"error": error} if error else {})
+                }
+                asyncio.get_running_loop().run_in_executor(
+                    None, lambda: log_agent_call(req.agent_id, "sync_fetch", details, size=sent)
+                )
+
+    return ClosingStreamingResponse(
+        stream(),
+        media_type="application/octet-stream",
+        headers={"Content-Length": str(length), "X-Porta-File-Size": str(st.st_size)}
+    )
+
+
+@app.post("/sync/patch")
+def sync_patch(req: SyncPatchRequest):
+    """Применяет присланную клиентом дельту к файлу на сервере"""
+    try:
+        validate_block_size(req.block_size)
+        full_path = resolve_sync_file(req.path, must_exist=False)
+        logger.info(f"Применение дельты к файлу: {full_path}")
+
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        tmp_path = f"{full_path}.porta-sync-{os.getpid()}-{threading.get_ident()}"
+        digest = hashlib.sha256()
+        written = 0
+        literal_bytes = 0
+
+        try:
+            basis = open(full_path, "rb") if os.path.exists(full_path) else None
+            try:
+                with open(tmp_path, "wb") as out:
+                    for op in req.ops:
+                        if op.op == "copy":
+                            if basis is None or op.index is None or op.index < 0 or op.count < 1:
+                                raise HTTPException(status_code=400, detail="Некорректная операция copy")
+                            basis.seek(op.index * req.block_size)
+                            chunk = basis.read(op.count * req.block_size)
+                            if not chunk:
+                                raise HTTPException(status_code=400, detail="Блок вне границ файла")
+                        elif op.op == "data":
+                            try:
+                                chunk = base64.b64decode(op.data or "", validate=True)
+                            except binascii.Error:
+                                raise HTTPException(status_code=400, detail="Некорректные данные base64 в операции data")
+                            literal_bytes += len(chunk)
+                        else:
+                            raise HTTPException(status_code=400, detail=f"Неизвестная операция: {op.op}")
+                        out.write(chunk)
+                        digest.update(chunk)
+                        written += len(chunk)
+            finally:
+                if basis is not None:
+                    basis.close()
+
+            file_hash = digest.hexdigest()
+            if req.hash and req.hash != file_hash:
+                raise HTTPException(status_code=409, detail="Хэш результата не совпадает, файл изменился")
+
+            os.replace(tmp_path, full_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        response = {
+            "success": True,
+            "message": "Дельта успешно применена",
+            "path": full_path,
+            "size": written,
+            "hash": file_hash,
+            "literal_bytes": literal_bytes
+        }
+
+        if req.agent_id:
+            response["agent_id"] = req.agent_id
+            log_agent_call(req.agent_id, "sync_patch", response, size=literal_bytes)
+
+        return response
+
+    except HTTPException:
+        raise
+
+    except Exception as e:
+        logger.error(f"Ошибка применения дельты: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Ошибка применения дельты: {str(e)}")
+
+
+@app.post("/agent/list")
+def agent_list(request: AgentListRequest):
+    """Возвращает список зарегистрированных агентов"""
+    try:
+        conn = connect_agents_db()
+        cursor = conn.cursor()
+        
+        # Формируем запрос с фильтрами
+        query = "SELECT id, name, created_at, last_seen, total_operations, status FROM agents"
+        params = []
+        
+        if request.status:
+            query += " WHERE status = ?"
+            params.append(request.status)
+        
+        query += " ORDER BY last_seen DESC LIMIT ? OFFSET ?"
+        params.extend([request.limit, request.offset])
+        
+        cursor.execute(query, params)
+        agents = []
+        
+        for row in cursor.fetchall():
+            agents.append({
+                "id": row[0],
+                "name": row[1],
+                "created_at": row[2],
+                "last_seen": row[3],
+                "total_operations": row[4],
+                "status": row[5]
+            })
+        
+        conn.close()
+        
+        result = {
+            "success": True,
+            "agents": agents,
+            "total": len(agents),
+            "limit": request.limit,
+            "offset": request.offset
+        }
+        
+        return result
+        
+    except Exception as e:
+        logger.error(f"Ошибка получения списка агентов: {e}")
+        raise HTTPException(status_code=500, detail=f"Ошибка получения списка агентов: {str(e)}")
 
 
 @app.post("/agent/history")
 def agent_history(request: AgentHistoryRequest):
     """Возвращает историю операций агента"""
     try:
-        conn = sqlite3.connect(AGENTS_DB)
+        conn = connect_agents_db()
         cursor = conn.cursor()
         
         # Формируем запрос с фильтрами
@@ -664,39 +2564,109 @@ def agent_history(request: AgentHistoryRequest):
         raise HTTPException(status_code=500, detail=f"Ошибка получения истории агента: {str(e)}")
 
 
+@app.post("/agent/limits")
+def agent_limits(request: AgentLimitsRequest):
+    """Читает или задаёт лимиты ресурсов для команд агента"""
+    try:
+        if not request.clear:
+            check_limits_supported(request.limits)
+        conn = connect_agents_db()
+        cursor = conn.cursor()
+        
+        if request.clear:
+            cursor.execute("DELETE FROM agent_limits WHERE agent_id = ?", (request.agent_id,))
+        elif request.limits:
+            cursor.execute(
+                """INSERT INTO agent_limits (agent_id, cpu_seconds, memory_mb, max_processes, updated_at)
+                   VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+                   ON CONFLICT(agent_id) DO UPDATE SET
+                       cpu_seconds = excluded.cpu_seconds,
+                       memory_mb = excluded.memory_mb,
+                       max_processes = excluded.max_processes,
+                       updated_at = CURRENT_TIMESTAMP""",
+                (request.agent_id, request.limits.cpu_seconds, request.limits.memory_mb, request.limits.max_processes)
+            )
+        
+        conn.commit()
+        conn.close()
+        
+        limits = get_agent_limits(request.agent_id)
+        
+        return {
+            "success": True,
+            "agent_id": request.agent_id,
+            "limits": limits.model_dump() if limits else None
+        }
+        
+    except HTTPException:
+        raise
+
+    except Exception as e:
+        logger.error(f"Ошибка работы с лимитами агента {request.agent_id}: {e}")
+        raise HTTPException(status_code=500, detail=f"Ошибка работы с лимитами агента: {str(e)}")
+
+
+@app.post("/agent/stats")
+def agent_stats(request: AgentStatsRequest):
+    """Возвращает агрегированную статистику агентов без сканирования истории операций"""
+    try:
+        if request.agent_id:
+            stats = agent_analytics.agent_stats(request.agent_id, request.operation_type, request.hours)
+            return {"success": True, "agent_id": request.agent_id, **stats}
+        
+        return {"success": True, "agents": agent_analytics.all_agents()}
+        
+    except Exception as e:
+        logger.error(f"Ошибка получения статистики агентов: {e}")
+        raise HTTPException(status_code=500, detail=f"Ошибка получения статистики агентов: {str(e)}")
+
+
 @app.post("/agent/pipeline")
 def agent_pipeline(request: AgentPipelineRequest):
     """Выполняет последовательность команд для агента"""
+    return execute_pipeline(request)
+
+
+def execute_pipeline(request: AgentPipelineRequest, on_result: Optional[Callable[[Dict[str, Any]], None]] = None):
+    """Выполняет pipeline, по желанию сообщая о результате каждой команды через on_result"""
     try:
         logger.info(f"Выполнение pipeline для агента {request.agent_id}: {len(request.commands)} команд")
         
         results = []
         start_time = time.time()
+        limits = merge_limits(request.limits, get_agent_limits(request.agent_id))
+        check_limits_supported(limits)
+
+        def add_result(result: Dict[str, Any]):
+            results.append(result)
+            if on_result:
+                on_result(result)
         
         for i, cmd in enumerate(request.commands):
             try:
                 # Выполняем команду
-                process = run(cmd, shell=True, capture_output=True, text=True, timeout=request.timeout)
+                process = execute_command(cmd, timeout=request.timeout, limits=limits)
                 
                 result = {
                     "command": cmd,
                     "index": i,
-                    "success": process.returncode == 0,
-                    "stdout": process.stdout,
-                    "stderr": process.stderr,
-                    "returncode": process.returncode
+                    "success": process["returncode"] == 0,
+                    "stdout": process["stdout"],
+                    "stderr": process["stderr"],
+                    "returncode": process["returncode"],
+                    "resources": process["resources"]
                 }
                 
-                results.append(result)
+                add_result(result)
                 
                 # Если команда завершилась с ошибкой, останавливаем pipeline
-                if process.returncode != 0:
+                if process["returncode"] != 0:
                     logger.warning(f"Команда {i+1} завершилась с ошибкой: {cmd}")
                     break
                     
             except TimeoutExpired:
                 logger.error(f"Таймаут команды {i+1}: {cmd}")
-                results.append({
+                add_result({
                     "command": cmd,
                     "index": i,
                     "success": False,
@@ -704,10 +2674,21 @@ def agent_pipeline(request: AgentPipelineRequest):
                     "returncode": -1
                 })
                 break
+
+            except CommandCancelled:
+                logger.info(f"Pipeline отменён на команде {i+1}: {cmd}")
+                add_result({
+                    "command": cmd,
+                    "index": i,
+                    "success": False,
+                    "error": "cancelled",
+                    "returncode": -1
+                })
+                break
                 
             except Exception as e:
                 logger.error(f"Ошибка выполнения команды {i+1}: {cmd} - {e}")
-                results.append({
+                add_result({
                     "command": cmd,
                     "index": i,
                     "success": False,
@@ -724,18 +2705,1738 @@ def agent_pipeline(request: AgentPipelineRequest):
             "total_commands": len(request.commands),
             "executed_commands": len(results),
             "execution_time": execution_time,
+            "resources": {
+                "user_cpu": round(sum(r.get("resources", {}).get("user_cpu", 0) for r in results), 4),
+                "sys_cpu": round(sum(r.get("resources", {}).get("sys_cpu", 0) for r in results), 4),
+                "max_rss_kb": max((r.get("resources", {}).get("max_rss_kb", 0) for r in results), default=0),
+                "read_bytes": sum(r.get("resources", {}).get("read_bytes", 0) for r in results),
+                "write_bytes": sum(r.get("resources", {}).get("write_bytes", 0) for r in results)
+            },
             "results": results
         }
         
         # Логируем операцию агента
-        log_agent_call(request.agent_id, "pipeline", response)
+        log_agent_call(request.agent_id, "pipeline", response, size=payload_size(
+            *request.commands, *(r.get("stdout") for r in results), *(r.get("stderr") for r in results)
+        ))
         
         return response
         
+    except HTTPException:
+        raise
+
     except Exception as e:
         logger.error(f"Ошибка выполнения pipeline для агента {request.agent_id}: {e}")
         raise HTTPException(status_code=500, detail=f"Ошибка выполнения pipeline: {str(e)}")
 
 
+# ===== Индексированное хранилище графов Memory Bank =====
+
+MEMORY_BANK_DIR = os.getenv("PORTA_MEMORY_BANK_DIR", "memory-bank-data")
+GRAPH_SNAPSHOT_OPS = 200         # Снимок после N операций в журнале
+GRAPH_SNAPSHOT_INTERVAL = 30     # или если с прошлого снимка прошло N секунд
+GRAPH_SNAPSHOT_CHECK_INTERVAL = 5  # Как часто фоновый поток проверяет журналы, секунд
+
+GRAPH_TOKEN_RE = re.compile(r"[^\W_]+", re.UNICODE)
+
+
+def graph_timestamp() -> str:
+    """Метка времени в формате graphology (ISO, миллисекунды, UTC)"""
+    return datetime.now(timezone.utc).isoformat(timespec="milliseconds").replace("+00:00", "Z")
+
+
+def graph_tokens(value: Any) -> set:
+    """Извлекает токены для полнотекстового индекса из произвольного значения"""
+    tokens = set()
+    if isinstance(value, dict):
+        for key, item in value.items():
+            if key == "metadata":
+                continue
+            tokens |= graph_tokens(item)
+    elif isinstance(value, list):
+        for item in value:
+            tokens |= graph_tokens(item)
+    elif value is not None:
+        tokens.update(t.lower() for t in GRAPH_TOKEN_RE.findall(str(value)))
+    return tokens
+
+
+class GraphStore:
+    """Граф проекта в памяти с индексами и журналом изменений"""
+
+    def __init__(self, project: str):
+        self.project = project
+        self.graph_path = os.path.join(MEMORY_BANK_DIR, project, "graph.json")
+        self.log_path = os.path.join(MEMORY_BANK_DIR, project, "graph.log.jsonl")
+        self.lock = threading.RLock()
+        self.file_state = None
+        self.load()
+
+    def reset(self):
+        self.options = {"type": "directed", "multi": True, "allowSelfLoops": True}
+        self.attributes = {}
+        self.metadata = {}
+        self.nodes = {}
+        self.edges = {}
+        self.by_type = {}
+        self.by_label = {}
+        self.text_index = {}
+        self.node_tokens = {}
+        self.out_edges = {}
+        self.in_edges = {}
+        self.log_ops = 0
+        self.last_snapshot = time.time()
+
+    def stat_graph_file(self):
+        try:
+            st = os.stat(self.graph_path)
+            return (st.st_mtime_ns, st.st_size)
+        except FileNotFoundError:
+            return None
+
+    def load(self):
+        """Загружает снимок graph.json и проигрывает поверх него журнал"""
+        with self.lock:
+            self.reset()
+            if os.path.exists(self.graph_path):
+                with open(self.graph_path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+                self.options = data.get("options", self.options)
+                self.attributes = data.get("attributes", {})
+                self.metadata = data.get("metadata", {})
+                for node in data.get("nodes", []):
+                    self.index_node(node["key"], node.get("attributes", {}))
+                for edge in data.get("edges", []):
+                    self.index_edge(edge["key"], edge["source"], edge["target"], edge.get("attributes", {}))
+            self.file_state = self.stat_graph_file()
+
+            if os.path.exists(self.log_path):
+                with open(self.log_path, "r", encoding="utf-8") as f:
+                    for line in f:
+                        if not line.strip():
+                            continue
+                        try:
+                            self.apply_op(json.loads(line))
+                            self.log_ops += 1
+                        except Exception as e:
+                            logger.warning(f"Пропуск записи журнала графа {self.project}: {e}")
+            logger.info(f"Граф {self.project} загружен: {len(self.nodes)} узлов, {len(self.edges)} рёбер")
+
+    def refresh(self):
+        """Перечитывает граф, если graph.json изменили извне"""
+        with self.lock:
+            if self.stat_graph_file() != self.file_state:
+                logger.info(f"Граф {self.project} изменён извне, перезагрузка")
+                self.load()
+
+    # --- Индексы ---
+
+    def index_node(self, key: str, attributes: Dict[str, Any]):
+        if key in self.nodes:
+            self.unindex_node(key)
+        self.nodes[key] = attributes
+        self.by_type.setdefault(attributes.get("type"), set()).add(key)
+        self.by_label.setdefault(str(attributes.get("label", "")).lower(), set()).add(key)
+        tokens = graph_tokens(attributes) | {key.lower()}
+        self.node_tokens[key] = tokens
+        for token in tokens:
+            self.text_index.setdefault(token, set()).add(key)
+        self.out_edges.setdefault(key, set())
+        self.in_edges.setdefault(key, set())
+
+    def unindex_node(self, key: str):
+        attributes = self.nodes.pop(key)
+        for index, value in ((self.by_type, attributes.get("type")),
+                             (self.by_label, str(attributes.get("label", "")).lower())):
+            keys = index.get(value)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del index[value]
+        for token in self.node_tokens.pop(key, ()):
+            keys = self.text_index.get(token)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.text_index[token]
+
+    def index_edge(self, key: str, source: str, target: str, attributes: Dict[str, Any]):
+        if key in self.edges:
+            self.unindex_edge(key)
+        self.edges[key] = {"key": key, "source": source, "target": target, "attributes": attributes}
+        self.out_edges.setdefault(source, set()).add(key)
+        self.in_edges.setdefault(target, set()).add(key)
+
+    def unindex_edge(self, key: str):
+        edge = self.edges.pop(key)
+        self.out_edges.get(edge["source"], set()).discard(key)
+        self.in_edges.get(edge["target"], set()).discard(key)
+
+    # --- Изменения ---
+
+    def apply_op(self, op: Dict[str, Any]):
+        kind = op["op"]
+        if kind == "upsert_node":
+            self.index_node(op["key"], op["attributes"])
+        elif kind == "delete_node":
+            key = op["key"]
+            if key in self.nodes:
+                for edge_key in list(self.out_edges.get(key, ())) + list(self.in_edges.get(key, ())):
+                    if edge_key in self.edges:
+                        self.unindex_edge(edge_key)
+                self.unindex_node(key)
+                self.out_edges.pop(key, None)
+                self.in_edges.pop(key, None)
+        elif kind == "upsert_edge":
+            self.index_edge(op["key"], op["source"], op["target"], op["attributes"])
+        elif kind == "delete_edge":
+            if op["key"] in self.edges:
+                self.unindex_edge(op["key"])
+        else:
+            raise ValueError(f"Неизвестная операция: {kind}")
+
+    def update(self, ops: List[GraphOp]) -> Dict[str, int]:
+        """Применяет изменения, дописывает их в журнал и при необходимости делает снимок"""
+        now = graph_timestamp()
+        applied = {"nodes_upserted": 0, "nodes_deleted": 0, "edges_upserted": 0, "edges_deleted": 0}
+
+        with self.lock:
+            self.refresh()
+            records = []
+            # Узлы, изменённые операциями запроса: key -> атрибуты или None после удаления.
+            # Операции проверяются по порядку относительно состояния с учётом предыдущих
+            batch_nodes = {}
+
+            def node_attributes(key: str) -> Optional[Dict[str, Any]]:
+                return batch_nodes[key] if key in batch_nodes else self.nodes.get(key)
+
+            for op in ops:
+                if op.op == "upsert_node":
+                    if not op.key:
+                        raise HTTPException(status_code=400, detail="Для узла нужен key")
+                    previous = node_attributes(op.key) or {}
+                    attributes = {**previous, **(op.attributes or {}), "id": op.key}
+                    attributes["metadata"] = self.bump_metadata(previous.get("metadata"), now)
+                    batch_nodes[op.key] = attributes
+                    records.append({"op": "upsert_node", "key": op.key, "attributes": attributes})
+                    applied["nodes_upserted"] += 1
+                elif op.op == "delete_node":
+                    if not op.key:
+                        raise HTTPException(status_code=400, detail="Для удаления узла нужен key")
+                    batch_nodes[op.key] = None
+                    records.append({"op": "delete_node", "key": op.key})
+                    applied["nodes_deleted"] += 1
+                elif op.op == "upsert_edge":
+                    if not op.source or not op.target:
+                        raise HTTPException(status_code=400, detail="Для ребра нужны source и target")
+                    # Ребро может ссылаться только на узлы, существующие на момент этой операции
+                    for endpoint in (op.source, op.target):
+                        if node_attributes(endpoint) is None:
+                            raise HTTPException(status_code=404, detail=f"Узел не найден: {endpoint}")
+                    key = op.key or f"geid_porta_{uuid.uuid4().hex[:12]}"
+                    previous = self.edges.get(key, {}).get("attributes", {})
+                    attributes = {**previous, **(op.attributes or {})}
+                    attributes["metadata"] = self.bump_metadata(previous.get("metadata"), now)
+                    records.append({"op": "upsert_edge", "key": key, "source": op.source,
+                                    "target": op.target, "attributes": attributes})
+                    applied["edges_upserted"] += 1
+                elif op.op == "delete_edge":
+                    if not op.key:
+                        raise HTTPException(status_code=400, detail="Для удаления ребра нужен key")
+                    records.append({"op": "delete_edge", "key": op.key})
+                    applied["edges_deleted"] += 1
+                else:
+                    raise HTTPException(status_code=400, detail=f"Неизвестная операция: {op.op}")
+
+            with open(self.log_path, "a", encoding="utf-8") as f:
+                for record in records:
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+            for record in records:
+                self.apply_op(record)
+            self.log_ops += len(records)
+
+            if self.log_ops >= GRAPH_SNAPSHOT_OPS or time.time() - self.last_snapshot >= GRAPH_SNAPSHOT_INTERVAL:
+                self.snapshot()
+
+        return applied
+
+    @staticmethod
+    def bump_metadata(metadata: Optional[Dict[str, Any]], now: str) -> Dict[str, Any]:
+        if not metadata:
+            return {"createdAt": now, "lastModified": now, "version": 1}
+        return {**metadata, "lastModified": now, "version": metadata.get("version", 0) + 1}
+
+    def flush(self, force: bool = False):
+        """Сохраняет журнал в снимок, если он не пуст и снимок устарел (или force).
+
+        Перед снимком граф сверяется с graph.json, чтобы не затереть внешние правки.
+        """
+        with self.lock:
+            if not self.log_ops:
+                return
+            if not force and time.time() - self.last_snapshot < GRAPH_SNAPSHOT_INTERVAL:
+                return
+            self.refresh()
+            self.snapshot()
+
+    def snapshot(self):
+        """Сохраняет граф в graph.json в формате graphology и очищает журнал"""
+        with self.lock:
+            if not self.log_ops:
+                return
+            nodes = [{"key": key, "attributes": self.nodes[key]} for key in sorted(self.nodes)]
+            edges = sorted(
+                self.edges.values(),
+                key=lambda e: (e["source"], e["target"], e["attributes"].get("relationshipType", ""))
+            )
+            data = {
+                "options": self.options,
+                "attributes": self.attributes,
+                "nodes": nodes,
+                "edges": edges,
+                "metadata": {
+                    "lastSaved": graph_timestamp(),
+                    "nodeCount": len(nodes),
+                    "edgeCount": len(edges),
+                    "version": self.metadata.get("version", 0) + 1
+                }
+            }
+            tmp_path = f"{self.graph_path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self.graph_path)
+            open(self.log_path, "w").close()
+
+            self.metadata = data["metadata"]
+            self.file_state = self.stat_graph_file()
+            self.log_ops = 0
+            self.last_snapshot = time.time()
+            logger.info(f"Снимок графа {self.project} сохранён")
+
+    # --- Запросы ---
+
+    def node_view(self, key: str) -> Dict[str, Any]:
+        return {"key": key, "attributes": self.nodes[key]}
+
+    def query(self, node_type: Optional[str], label: Optional[str], keys: Optional[List[str]]) -> List[str]:
+        with self.lock:
+            candidates = None
+            if keys:
+                candidates = {k for k in keys if k in self.nodes}
+            if node_type:
+                found = self.by_type.get(node_type, set())
+                candidates = found if candidates is None else candidates & found
+            if label:
+                found = self.by_label.get(label.lower(), set())
+                candidates = found if candidates is None else candidates & found
+            if candidates is None:
+                candidates = self.nodes.keys()
+            return sorted(candidates)
+
+    def search(self, text: str, node_type: Optional[str]) -> List[Dict[str, Any]]:
+        with self.lock:
+            tokens = [t.lower() for t in GRAPH_TOKEN_RE.findall(text)]
+            scores = {}
+            for token in tokens:
+                for key in self.text_index.get(token, ()):
+                    scores[key] = scores.get(key, 0) + 1
+            if node_type:
+                allowed = self.by_type.get(node_type, set())
+                scores = {k: v for k, v in scores.items() if k in allowed}
+            ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+            return [{"score": score, **self.node_view(key)} for key, score in ranked]
+
+    def neighborhood(self, key: str, depth: int, direction: str, relationship_type: Optional[str]):
+        with self.lock:
+            if key not in self.nodes:
+                raise HTTPException(status_code=404, detail=f"Узел не найден: {key}")
+            visited = {key}
+            frontier = [key]
+            edge_keys = set()
+            for _ in range(depth):
+                next_frontier = []
+                for current in frontier:
+                    adjacent = []
+                    if direction in ("out", "both"):
+                        adjacent += [(e, "target") for e in self.out_edges.get(current, ())]
+                    if direction in ("in", "both"):
+                        adjacent += [(e, "source") for e in self.in_edges.get(current, ())]
+                    for edge_key, side in adjacent:
+                        edge = self.edges[edge_key]
+                        if relationship_type and edge["attributes"].get("relationshipType") != relationship_type:
+                            continue
+                        edge_keys.add(edge_key)
+                        neighbour = edge[side]
+                        if neighbour not in visited and neighbour in self.nodes:
+                            visited.add(neighbour)
+                            next_frontier.append(neighbour)
+                frontier = next_frontier
+            return (
+                [self.node_view(k) for k in sorted(visited)],
+                [self.edges[k] for k in sorted(edge_keys)]
+            )
+
+
+graph_stores = {}
+graph_stores_lock = threading.Lock()
+
+
+def get_graph_store(project: str) -> GraphStore:
+    """Возвращает загруженный граф проекта, подхватывая внешние изменения файла"""
+    if not project or "/" in project or "\\" in project or project.startswith("."):
+        raise HTTPException(status_code=400, detail="Недопустимое имя проекта")
+
+    with graph_stores_lock:
+        store = graph_stores.get(project)
+        if store is None:
+            if not os.path.isdir(os.path.join(MEMORY_BANK_DIR, project)):
+                raise HTTPException(status_code=404, detail=f"Проект не найден: {project}")
+            store = GraphStore(project)
+            graph_stores[project] = store
+            return store
+
+    store.refresh()
+    return store
+
+
+graph_snapshot_stop = threading.Event()
+
+
+def snapshot_graph_stores(force: bool = False):
+    """Сохраняет снимки загруженных графов, у которых есть несохранённый журнал"""
+    with graph_stores_lock:
+        stores = list(graph_stores.values())
+    for store in stores:
+        try:
+            store.flush(force)
+        except Exception as e:
+            logger.error(f"Ошибка сохранения снимка графа {store.project}: {e}")
+
+
+def run_graph_snapshots():
+    """Фоновый поток: журнал попадает в graph.json даже без новых изменений"""
+    while not graph_snapshot_stop.wait(GRAPH_SNAPSHOT_CHECK_INTERVAL):
+        snapshot_graph_stores()
+
+
+def start_graph_snapshots():
+    graph_snapshot_stop.clear()
+    threading.Thread(target=run_graph_snapshots, name="porta-graph-snapshots", daemon=True).start()
+
+
+@app.post("/graph/query")
+def graph_query(req: GraphQueryRequest):
+    """Поиск узлов графа по типу, метке или ключам через индексы"""
+    try:
+        store = get_graph_store(req.project)
+        keys = store.query(req.type, req.label, req.keys)
+        with store.lock:
+            nodes = [store.node_view(k) for k in keys[req.offset:req.offset + req.limit] if k in store.nodes]
+
+        response = {
+            "success": True,
+            "project": req.project,
+            "nodes": nodes,
+            "total": len(keys),
+            "limit": req.limit,
+            "offset": req.offset
+        }
+
+        if req.agent_id:
+            response["agent_id"] = req.agent_id
+            log_agent_call(req.agent_id, "graph_query", {"success": True, "project": req.project, "total": len(keys)},
+                           size=payload_size(json.dumps(nodes)))
+
+        return response
+
+    except HTTPException:
+        raise
+
+    except Exception as e:
+        logger.error(f"Ошибка запроса к графу: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Ошибка запроса к графу: {str(e)}")
+
+
+@app.post("/graph/neighborhood")
+def graph_neighborhood(req: GraphNeighborhoodRequest):
+    """Возвращает окрестность узла по спискам смежности"""
+    try:
+        if req.direction not in ("out", "in", "both"):
+            raise HTTPException(status_code=400, detail="direction должен быть out, in или both")
+
+        store = get_graph_store(req.project)
+        nodes, edges = store.neighborhood(req.node, max(0, min(req.depth, 5)), req.direction, req.relationship_type)
+
+        response = {
+            "success": True,
+            "project": req.project,
+            "node": req.node,
+            "nodes": nodes,
+            "edges": edges
+        }
+
+        if req.agent_id:
+            response["agent_id"] = req.agent_id
+            log_agent_call(req.agent_id, "graph_neighborhood", {
+                "success": True, "project": req.project, "node": req.node,
+                "nodes": len(nodes), "edges": len(edges)
+            }, size=payload_size(json.dumps([nodes, edges])))
+
+        return response
+
+    except HTTPException:
+        raise
+
+    except Exception as e:
+        logger.error(f"Ошибка получения окрестности узла: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Ошибка получения окрестности узла: {str(e)}")
+
+
+@app.post("/graph/search")
+def graph_search(req: GraphSearchRequest):
+    """Полнотекстовый поиск по атрибутам узлов"""
+    try:
+        store = get_graph_store(req.project)
+        results = store.search(req.query, req.type)
+
+        response = {
+            "success": True,
+            "project": req.project,
+            "query": req.query,
+            "nodes": results[:req.limit],
+            "total": len(results)
+        }
+
+        if req.agent_id:
+            response["agent_id"] = req.agent_id
+            log_agent_call(req.agent_id, "graph_search", {
+                "success": True, "project": req.project, "query": req.query, "total": len(results)
+            }, size=payload_size(json.dumps(response["nodes"])))
+
+        return response
+
+    except HTTPException:
+        raise
+
+    except Exception as e:
+        logger.error(f"Ошибка поиска по графу: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Ошибка поиска по графу: {str(e)}")
+
+
+@app.post("/graph/update")
+def graph_update(req: GraphUpdateRequest):
+    """Изменяет граф: изменения дописываются в журнал, снимок сохраняется периодически"""
+    try:
+        store = get_graph_store(req.project)
+        applied = store.update(req.ops)
+
+        response = {
+            "success": True,
+            "project": req.project,
+            **applied,
+            "node_count": len(store.nodes),
+            "edge_count": len(store.edges)
+        }
+
+        if req.agent_id:
+            response["agent_id"] = req.agent_id
+            log_agent_call(req.agent_id, "graph_update", response,
+                           size=payload_size(json.dumps([op.model_dump() for op in req.ops])))
+
+        broadcast_notification("porta/graphChanged", {
+            key: value for key, value in response.items() if key != "success"
+        })
+
+        return response
+
+    except HTTPException:
+        raise
+
+    except Exception as e:
+        logger.error(f"Ошибка изменения графа: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Ошибка изменения графа: {str(e)}")
+
+
+# ===== Архивы директорий =====
+
+ARCHIVE_FORMATS = ("tar.gz", "tar", "zip")
+ARCHIVE_CHUNK_SIZE = 64 * 1024
+ARCHIVE_QUEUE_CHUNKS = 16                  # Ограничивает память потоковой выдачи
+ARCHIVE_MAX_UPLOAD = int(os.getenv("PORTA_ARCHIVE_MAX_UPLOAD", 1024 * 1024 * 1024))
+ARCHIVE_MAX_EXTRACT = int(os.getenv("PORTA_ARCHIVE_MAX_EXTRACT", 4 * 1024 * 1024 * 1024))  # Байт после распаковки
+ARCHIVE_MAX_MEMBERS = int(os.getenv("PORTA_ARCHIVE_MAX_MEMBERS", 100000))
+
+
+class ArchiveStreamCancelled(Exception):
+    """Клиент прервал скачивание архива или загрузка архива прервана"""
+
+
+class ArchiveLimitExceeded(Exception):
+    """Распакованный архив превышает лимит объёма или числа элементов"""
+
+
+class QueueWriter:
+    """Файлоподобный приёмник: копит запись в чанки и передаёт их в ограниченную очередь"""
+
+    def __init__(self, chunks: queue.Queue, cancelled: threading.Event):
+        self.chunks = chunks
+        self.cancelled = cancelled
+        self.buffer = bytearray()
+
+    def write(self, data) -> int:
+        self.buffer += data
+        if len(self.buffer) >= ARCHIVE_CHUNK_SIZE:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        if not self.buffer:
+            return
+        chunk, self.buffer = bytes(self.buffer), bytearray()
+        while True:
+            if self.cancelled.is_set():
+                raise ArchiveStreamCancelled()
+            try:
+                self.chunks.put(chunk, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+
+class QueueReader:
+    """Файлоподобный источник: отдаёт на чтение чанки, которые другой поток передаёт в feed"""
+
+    def __init__(self, maxsize: int):
+        self.chunks = queue.Queue(maxsize=maxsize)
+        self.cancelled = threading.Event()
+        self.buffer = bytearray()
+        self.eof = False
+
+    def feed(self, chunk: bytes):
+        """Передаёт чанк читателю; пустой чанк означает конец потока"""
+        while True:
+            if self.cancelled.is_set():
+                raise ArchiveStreamCancelled()
+            try:
+                self.chunks.put(chunk, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def read(self, size: int = -1) -> bytes:
+        while not self.eof and (size < 0 or len(self.buffer) < size):
+            if self.cancelled.is_set():
+                raise ArchiveStreamCancelled()
+            try:
+                chunk = self.chunks.get(timeout=1)
+            except queue.Empty:
+                continue
+            if chunk:
+                self.buffer += chunk
+            else:
+                self.eof = True
+        if size < 0 or size > len(self.buffer):
+            size = len(self.buffer)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def close(self):
+        self.cancelled.set()
+
+
+def archive_path_matches(rel_path: str, patterns: List[str]) -> bool:
+    """Совпадает ли путь или его имя с одним из glob-шаблонов"""
+    name = os.path.basename(rel_path)
+    return any(fnmatch.fnmatch(rel_path, p) or fnmatch.fnmatch(name, p) for p in patterns)
+
+
+def iter_archive_entries(root: str, include: List[str], exclude: List[str], include_hidden: bool):
+    """Обходит дерево и возвращает (полный путь, путь в архиве) с учётом фильтров"""
+    base = os.path.basename(root.rstrip(os.sep)) or "archive"
+    for current, dirs, files in os.walk(root):
+        rel_dir = os.path.relpath(current, root)
+        dirs[:] = sorted(
+            d for d in dirs
+            if (include_hidden or not d.startswith('.'))
+            and not archive_path_matches(os.path.normpath(os.path.join(rel_dir, d)), exclude)
+        )
+        for name in sorted(files):
+            if not include_hidden and name.startswith('.'):
+                continue
+            rel_path = os.path.normpath(os.path.join(rel_dir, name))
+            if exclude and archive_path_matches(rel_path, exclude):
+                continue
+            if include and not archive_path_matches(rel_path, include):
+                continue
+            yield os.path.join(current, name), os.path.join(base, rel_path)
+
+
+def write_archive(writer: QueueWriter, fmt: str, entries) -> None:
+    """Пишет архив в writer; выполняется в отдельном потоке"""
+    if fmt == "zip":
+        with zipfile.ZipFile(writer, "w", compression=zipfile.ZIP_DEFLATED, allowZip64=True) as zf:
+            for full_path, arcname in entries:
+                if os.path.islink(full_path):
+                    continue
+                zf.write(full_path, arcname)
+    else:
+        with tarfile.open(fileobj=writer, mode="w|gz" if fmt == "tar.gz" else "w|") as tar:
+            for full_path, arcname in entries:
+                tar.add(full_path, arcname=arcname, recursive=False)
+    writer.flush()
+
+
+@app.post("/archive/download")
+def archive_download(req: ArchiveDownloadRequest):
+    """Потоково отдаёт tar.gz/tar/zip директории с фильтрами include/exclude"""
+    if req.format not in ARCHIVE_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Формат должен быть одним из: {', '.join(ARCHIVE_FORMATS)}")
+    if is_forbidden_path(req.path):
+        logger.error(f"Недопустимый путь: {req.path}")
+        raise HTTPException(status_code=400, detail="Недопустимый путь")
+
+    full_path = os.path.abspath(req.path)
+    if not os.path.exists(full_path):
+        logger.error(f"Папка не существует: {full_path}")
+        raise HTTPException(status_code=404, detail="Папка не найдена")
+    if not os.path.isdir(full_path):
+        logger.error(f"Путь не является папкой: {full_path}")
+        raise HTTPException(status_code=400, detail="Указанный путь не является папкой")
+
+    logger.info(f"Архивирование папки: {full_path} ({req.format})")
+
+    chunks = queue.Queue(maxsize=ARCHIVE_QUEUE_CHUNKS)
+    cancelled = threading.Event()
+    done = object()
+
+    def produce():
+        try:
+            entries = iter_archive_entries(full_path, req.include, req.exclude, req.include_hidden)
+            write_archive(QueueWriter(chunks, cancelled), req.format, entries)
+            chunks.put(done)
+        except ArchiveStreamCancelled:
+            logger.info(f"Скачивание архива прервано клиентом: {full_path}")
+            try:
+                chunks.put_nowait(done)
+            except queue.Full:
+                pass
+        except Exception as e:
+            logger.error(f"Ошибка архивирования папки {full_path}: {e}")
+            chunks.put(e)
+
+    def next_chunk():
+        try:
+            return chunks.get(timeout=1)
+        except queue.Empty:
+            return None
+
+    async def stream():
+        producer = threading.Thread(target=produce, daemon=True)
+        producer.start()
+        sent = 0
+        error = "прервано клиентом"
+        try:
+            while True:
+                chunk = await run_in_threadpool(next_chunk)
+                if chunk is None:
+                    continue
+                if chunk is done:
+                    error = None
+                    break
+                if isinstance(chunk, Exception):
+                    error = str(chunk)
+                    raise chunk
+                sent += len(chunk)
+                yield chunk
+        finally:
+            cancelled.set()
+            # Аудит после выдачи: успех известен только когда архив передан целиком
+            if req.agent_id:
+                details = {
+                    "success": error is None, "path": full_path, "format": req.format,
+                    "include": req.include, "exclude": req.exclude, "size": sent,
+                    **({"error": error} if error else {})
+                }
+                asyncio.get_running_loop().run_in_executor(
+                    None, lambda: log_agent_call(req.agent_id, "archive_download", details, size=sent)
+                )
+
+    filename = f"{os.path.basename(full_path.rstrip(os.sep)) or 'archive'}.{req.format}"
+    return ClosingStreamingResponse(
+        stream(),
+        media_type="application/zip" if req.format == "zip" else "application/x-tar" if req.format == "tar" else "application/gzip",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+
+def safe_member_path(root: str, name: str) -> Optional[str]:
+    """Возвращает путь распаковки внутри root или None, если член архива выходит за его пределы"""
+    name = name.replace("\\", "/")
+    if not name or name.startswith("/") or re.match(r"^[A-Za-z]:", name):
+        return None
+    if any(part == ".." for part in name.split("/")):
+        return None
+    target = os.path.realpath(os.path.join(root, name))
+    if target != root and not target.startswith(root + os.sep):
+        return None
+    return target
+
+
+def extract_archive(archive, root: str, fmt: str, overwrite: bool) -> Dict[str, Any]:
+    """Распаковывает архив с проверкой путей; ссылки и специальные файлы пропускаются.
+
+    archive — путь к zip или файловый объект с потоком tar/tar.gz, который читается
+    последовательно. Объём распакованных данных и число элементов ограничены
+    ARCHIVE_MAX_EXTRACT и ARCHIVE_MAX_MEMBERS: при превышении недописанный файл
+    удаляется и выбрасывается ArchiveLimitExceeded.
+    """
+    stats = {"files": 0, "directories": 0, "bytes": 0, "skipped": []}
+    members = 0
+
+    def extract_member(name: str, is_dir: bool, mode: int, source):
+        nonlocal members
+        members += 1
+        if members > ARCHIVE_MAX_MEMBERS:
+            raise ArchiveLimitExceeded(f"в архиве больше {ARCHIVE_MAX_MEMBERS} элементов")
+        target = safe_member_path(root, name)
+        if target is None:
+            stats["skipped"].append(name)
+            return
+        if is_dir:
+            os.makedirs(target, exist_ok=True)
+            stats["directories"] += 1
+            return
+        if os.path.exists(target) and not overwrite:
+            stats["skipped"].append(name)
+            return
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        try:
+            with source() as src, open(target, "wb") as dst:
+                stats["bytes"] += copy_stream(src, dst, ARCHIVE_MAX_EXTRACT - stats["bytes"])
+        except ArchiveLimitExceeded:
+            os.remove(target)
+            raise
+        if mode:
+            os.chmod(target, mode & 0o755)
+        stats["files"] += 1
+
+    if fmt == "zip":
+        with zipfile.ZipFile(archive) as zf:
+            for info in zf.infolist():
+                unix_mode = info.external_attr >> 16
+                # Без битов типа (так пишет zipfile.writestr) член считается обычным файлом
+                if stat.S_IFMT(unix_mode) and not (stat.S_ISREG(unix_mode) or stat.S_ISDIR(unix_mode)):
+                    stats["skipped"].append(info.filename)
+                    continue
+                extract_member(info.filename, info.is_dir(), unix_mode & 0o777,
+                               lambda info=info: zf.open(info))
+    else:
+        with tarfile.open(fileobj=archive, mode="r|*") as tar:
+            for member in tar:
+                if not (member.isfile() or member.isdir()):
+                    stats["skipped"].append(member.name)
+                    continue
+                extract_member(member.name, member.isdir(), member.mode,
+                               lambda member=member: tar.extractfile(member))
+    return stats
+
+
+def copy_stream(src, dst, limit: int) -> int:
+    total = 0
+    for chunk in iter(lambda: src.read(ARCHIVE_CHUNK_SIZE), b""):
+        total += len(chunk)
+        if total > limit:
+            raise ArchiveLimitExceeded(f"распакованный архив больше {ARCHIVE_MAX_EXTRACT} байт")
+        dst.write(chunk)
+    return total
+
+
+@app.post("/archive/upload")
+async def archive_upload(request: Request, path: str, format: Optional[str] = None,
+                         overwrite: bool = True, agent_id: Optional[str] = None):
+    """Принимает архив в теле запроса и распаковывает его в path с проверкой путей"""
+    if is_forbidden_path(path):
+        logger.error(f"Недопустимый путь: {path}")
+        raise HTTPException(status_code=400, detail="Недопустимый путь")
+    if format is not None and format not in ARCHIVE_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Формат должен быть одним из: {', '.join(ARCHIVE_FORMATS)}")
+
+    root = os.path.realpath(path)
+    if os.path.exists(root) and not os.path.isdir(root):
+        raise HTTPException(status_code=400, detail="Указанный путь не является папкой")
+
+    logger.info(f"Загрузка архива в папку: {root}")
+    spool = None
+    reader = None
+    extraction = None
+    try:
+        size = 0
+        head = b""
+        write = None
+        try:
+            async for chunk in request.stream():
+                size += len(chunk)
+                if size > ARCHIVE_MAX_UPLOAD:
+                    raise HTTPException(status_code=413, detail="Архив слишком большой")
+                if write is None:
+                    # Копим начало тела, пока по сигнатуре нельзя определить формат
+                    head += chunk
+                    if len(head) < 4:
+                        continue
+                    chunk = head
+                    if format is None:
+                        format = "zip" if head.startswith(b"PK") else "tar.gz" if head.startswith(b"\x1f\x8b") else "tar"
+                    os.makedirs(root, exist_ok=True)
+                    if format == "zip":
+                        # Оглавление zip лежит в конце, поэтому zip сначала сохраняется на диск
+                        spool = tempfile.NamedTemporaryFile(prefix="porta-upload-", delete=False)
+                        write = spool.write
+                    else:
+                        # tar распаковывается по мере приёма тела
+                        reader = QueueReader(ARCHIVE_QUEUE_CHUNKS)
+                        extraction = asyncio.ensure_future(
+                            run_in_threadpool(extract_archive_stream, reader, root, format, overwrite)
+                        )
+                        write = reader.feed
+                try:
+                    await run_in_threadpool(write, chunk)
+                except ArchiveStreamCancelled:
+                    # Распаковка завершилась раньше конца тела — её результат ниже
+                    break
+        finally:
+            if spool is not None:
+                spool.close()
+
+        if write is None:
+            raise HTTPException(status_code=400, detail="Повреждённый архив: слишком короткий")
+
+        try:
+            if spool is not None:
+                stats = await run_in_threadpool(extract_archive, spool.name, root, format, overwrite)
+            else:
+                try:
+                    await run_in_threadpool(reader.feed, b"")
+                except ArchiveStreamCancelled:
+                    pass
+                stats = await extraction
+        except (tarfile.TarError, zipfile.BadZipFile, EOFError) as e:
+            logger.error(f"Повреждённый архив: {e}")
+            raise HTTPException(status_code=400, detail=f"Повреждённый архив: {str(e)}")
+        except ArchiveLimitExceeded as e:
+            logger.error(f"Архив превышает лимит распаковки: {e}")
+            raise HTTPException(status_code=413, detail=f"Архив превышает лимит распаковки: {str(e)}")
+
+        response = {
+            "success": True,
+            "message": "Архив успешно распакован",
+            "path": root,
+            "format": format,
+            "size": size,
+            **stats
+        }
+
+        if agent_id:
+            response["agent_id"] = agent_id
+            await run_in_threadpool(log_agent_call, agent_id, "archive_upload", response, size)
+
+        return response
+
+    except HTTPException:
+        raise
+
+    except Exception as e:
+        logger.error(f"Ошибка распаковки архива: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Ошибка распаковки архива: {str(e)}")
+
+    finally:
+        if reader is not None:
+            # Останавливает поток распаковки, если загрузка прервана
+            reader.close()
+            await asyncio.gather(extraction, return_exceptions=True)
+        if spool is not None:
+            os.remove(spool.name)
+
+
+def extract_archive_stream(reader: QueueReader, root: str, fmt: str, overwrite: bool) -> Dict[str, Any]:
+    """Распаковывает tar из потока; по завершении перестаёт принимать данные"""
+    try:
+        return extract_archive(reader, root, fmt, overwrite)
+    finally:
+        reader.close()
+
+
+# ===== Сэмплирующий профилировщик =====
+
+PROFILER_INTERVAL = float(os.getenv("PORTA_PROFILER_INTERVAL", 0.01))    # Период сэмплирования, секунд
+PROFILER_WINDOW = int(os.getenv("PORTA_PROFILER_WINDOW", 60))            # Окно непрерывного режима, секунд
+PROFILER_MAX_SECONDS = 60
+PROFILER_HELPER_PREFIX = "porta-"   # Служебные потоки Porta (профилировщик, читатели воркеров, таймеры)
+
+# Листовые кадры, в которых поток ждёт, а не работает: (файл, функция)
+PROFILER_IDLE_FRAMES = {
+    ("threading.py", "wait"),
+    ("threading.py", "_wait_for_tstate_lock"),
+    ("selectors.py", "select"),
+    ("socket.py", "accept"),
+    ("subprocess.py", "_try_wait"),
+}
+
+
+def is_idle_frame(frame) -> bool:
+    """Поток заблокирован в ожидании (блокировка, очередь, select), а не выполняет код"""
+    code = frame.f_code
+    return (os.path.basename(code.co_filename), code.co_name) in PROFILER_IDLE_FRAMES
+
+
+def sample_stacks(counter: Counter, skip_thread: int, include_idle: bool = False):
+    """Добавляет в counter свёрнутые стеки потоков, кроме skip_thread и служебных потоков Porta.
+
+    Без include_idle пропускаются потоки, стоящие в блокирующем ожидании, — иначе
+    простаивающие воркеры пула заслоняют горячие пути.
+    """
+    names = {t.ident: t.name for t in threading.enumerate()}
+    for thread_id, frame in sys._current_frames().items():
+        if thread_id == skip_thread:
+            continue
+        name = names.get(thread_id, str(thread_id))
+        if name.startswith(PROFILER_HELPER_PREFIX):
+            continue
+        if not include_idle and is_idle_frame(frame):
+            continue
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        stack.append(name)
+        counter[";".join(reversed(stack))] += 1
+
+
+def filter_stacks(stacks: Counter, thread: Optional[str]) -> Counter:
+    """Оставляет стеки потоков, в имени которых есть подстрока thread"""
+    if not thread:
+        return stacks
+    return Counter({stack: count for stack, count in stacks.items() if thread in stack.split(";", 1)[0]})
+
+
+class ContinuousProfiler:
+    """Фоновый сэмплер, хранящий стеки за последние PROFILER_WINDOW секунд"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.window = deque(maxlen=PROFILER_WINDOW)  # по Counter на каждую секунду
+        self.thread = None
+        self.stop_event = threading.Event()
+
+    @property
+    def running(self) -> bool:
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, name="porta-profiler", daemon=True)
+        self.thread.start()
+        logger.info("Непрерывный профилировщик запущен")
+
+    def stop(self):
+        self.stop_event.set()
+
+    def run(self):
+        own_id = threading.get_ident()
+        while not self.stop_event.is_set():
+            second = Counter()
+            deadline = time.monotonic() + 1
+            while time.monotonic() < deadline and not self.stop_event.is_set():
+                sample_stacks(second, own_id)
+                time.sleep(PROFILER_INTERVAL)
+            with self.lock:
+                self.window.append(second)
+
+    def snapshot(self, seconds: int) -> Counter:
+        with self.lock:
+            recent = list(self.window)[-seconds:]
+        total = Counter()
+        for second in recent:
+            total.update(second)
+        return total
+
+
+continuous_profiler = ContinuousProfiler()
+
+
+def speedscope_profile(stacks: Counter, name: str) -> Dict[str, Any]:
+    """Преобразует свёрнутые стеки в формат speedscope (sampled)"""
+    frames = []
+    frame_index = {}
+    samples = []
+    weights = []
+    for stack, count in stacks.items():
+        sample = []
+        for frame_name in stack.split(";"):
+            if frame_name not in frame_index:
+                frame_index[frame_name] = len(frames)
+                frames.append({"name": frame_name})
+            sample.append(frame_index[frame_name])
+        samples.append(sample)
+        weights.append(count * PROFILER_INTERVAL)
+    return {
+        "$schema": "https://www.speedscope.app/file-format-schema.json",
+        "shared": {"frames": frames},
+        "profiles": [{
+            "type": "sampled",
+            "name": name,
+            "unit": "seconds",
+            "startValue": 0,
+            "endValue": sum(weights),
+            "samples": samples,
+            "weights": weights
+        }],
+        "name": name,
+        "exporter": "porta"
+    }
+
+
+@app.get("/debug/profile")
+def debug_profile(seconds: int = 5, format: str = "collapsed", continuous: bool = False,
+                  idle: bool = False, thread: Optional[str] = None):
+    """Профилирует работающий сервер сэмплированием стеков потоков.
+
+    continuous=true отдаёт данные из окна непрерывного профилировщика без ожидания.
+    idle=true добавляет потоки в блокирующем ожидании (только для разового профиля),
+    thread оставляет потоки с этой подстрокой в имени.
+    """
+    if format not in ("collapsed", "speedscope"):
+        raise HTTPException(status_code=400, detail="format должен быть collapsed или speedscope")
+    seconds = max(1, min(seconds, PROFILER_MAX_SECONDS))
+
+    if continuous:
+        if not continuous_profiler.running:
+            raise HTTPException(status_code=409, detail="Непрерывный профилировщик не запущен (PORTA_PROFILER_CONTINUOUS=1)")
+        stacks = continuous_profiler.snapshot(seconds)
+    else:
+        logger.info(f"Профилирование сервера в течение {seconds} секунд")
+        stacks = Counter()
+        own_id = threading.get_ident()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            sample_stacks(stacks, own_id, include_idle=idle)
+            time.sleep(PROFILER_INTERVAL)
+    stacks = filter_stacks(stacks, thread)
+
+    if format == "speedscope":
+        return speedscope_profile(stacks, f"porta {os.getpid()} ({seconds}s)")
+
+    collapsed = "\n".join(f"{stack} {count}" for stack, count in stacks.most_common())
+    return PlainTextResponse(content=collapsed + "\n" if collapsed else "")
+
+
+# ===== Подписка на изменения файлов =====
+
+WATCH_MAX_PER_AGENT = 8           # Одновременных подписок на одного агента
+WATCH_MAX_TOTAL = 64              # Одновременных подписок на сервер
+WATCH_TAIL_MAX_BYTES = 64 * 1024  # Максимум дописанных байт в одном событии
+WATCH_HEARTBEAT = 15              # Период комментария-пинга в SSE, секунд
+WATCH_POLL_INTERVAL = 1.0         # Период опроса, если inotify недоступен
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+INOTIFY_EVENT = struct.Struct("iIII")
+
+try:
+    libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+    libc.inotify_init1.argtypes = [ctypes.c_int]
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    INOTIFY_AVAILABLE = True
+except (OSError, AttributeError):
+    libc = None
+    INOTIFY_AVAILABLE = False
+
+watch_counts = {}
+watch_counts_lock = threading.Lock()
+
+
+class FileWatcher:
+    """Следит за путями и glob-шаблонами через inotify (или опросом) и кладёт события в очередь"""
+
+    def __init__(self, patterns: List[str], tail: bool):
+        self.patterns = [os.path.abspath(p) for p in patterns]
+        self.tail = tail
+        self.queue = asyncio.Queue()
+        self.directories = {}  # wd -> путь директории
+        self.offsets = {}
+        self.fd = None
+        self.poll_task = None
+        self.loop = None
+
+        watch_dirs = set()
+        for pattern in self.patterns:
+            if glob.has_magic(pattern):
+                parent = os.path.dirname(pattern)
+                watch_dirs.update(d for d in glob.glob(parent) if os.path.isdir(d)) if glob.has_magic(parent) \
+                    else watch_dirs.add(parent)
+            elif os.path.isdir(pattern):
+                watch_dirs.add(pattern)
+            else:
+                watch_dirs.add(os.path.dirname(pattern))
+        self.watch_dirs = sorted(d for d in watch_dirs if os.path.isdir(d))
+        if not self.watch_dirs:
+            raise HTTPException(status_code=404, detail="Ни одна из директорий для наблюдения не найдена")
+
+        if tail:
+            for path in self.matching_files():
+                self.offsets[path] = os.path.getsize(path)
+
+    def matches(self, path: str) -> bool:
+        for pattern in self.patterns:
+            if glob.has_magic(pattern):
+                if fnmatch.fnmatch(path, pattern):
+                    return True
+            elif path == pattern or os.path.dirname(path) == pattern:
+                return True
+        return False
+
+    def matching_files(self) -> List[str]:
+        files = []
+        for directory in self.watch_dirs:
+            try:
+                with os.scandir(directory) as it:
+                    files.extend(e.path for e in it if e.is_file() and self.matches(e.path))
+            except OSError:
+                continue
+        return files
+
+    def start(self):
+        self.loop = asyncio.get_running_loop()
+        if not INOTIFY_AVAILABLE:
+            self.poll_task = asyncio.create_task(self.poll())
+            return
+
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        for directory in self.watch_dirs:
+            wd = libc.inotify_add_watch(self.fd, directory.encode(), WATCH_MASK)
+            if wd < 0:
+                logger.warning(f"Не удалось наблюдать за {directory}: errno {ctypes.get_errno()}")
+                continue
+            self.directories[wd] = directory
+        self.loop.add_reader(self.fd, self.read_events)
+
+    def read_events(self):
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset + INOTIFY_EVENT.size <= len(data):
+            wd, mask, _cookie, length = INOTIFY_EVENT.unpack_from(data, offset)
+            name = data[offset + INOTIFY_EVENT.size:offset + INOTIFY_EVENT.size + length].rstrip(b"\0").decode(errors="replace")
+            offset += INOTIFY_EVENT.size + length
+
+            if mask & IN_Q_OVERFLOW:
+                self.queue.put_nowait(("overflow", None))
+                continue
+            directory = self.directories.get(wd)
+            if directory is None:
+                continue
+            path = os.path.join(directory, name) if name else directory
+            if not self.matches(path):
+                continue
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                self.queue.put_nowait(("created", path))
+            elif mask & (IN_DELETE | IN_MOVED_FROM | IN_DELETE_SELF):
+                self.queue.put_nowait(("deleted", path))
+            elif mask & (IN_MODIFY | IN_CLOSE_WRITE):
+                self.queue.put_nowait(("modified", path))
+
+    async def poll(self):
+        """Запасной режим без inotify: сравнение size/mtime раз в WATCH_POLL_INTERVAL"""
+        def scan():
+            state = {}
+            for path in self.matching_files():
+                try:
+                    st = os.stat(path)
+                    state[path] = (st.st_size, st.st_mtime_ns)
+                except OSError:
+                    continue
+            return state
+
+        previous = await run_in_threadpool(scan)
+        while True:
+            await asyncio.sleep(WATCH_POLL_INTERVAL)
+            current = await run_in_threadpool(scan)
+            for path in current.keys() - previous.keys():
+                self.queue.put_nowait(("created", path))
+            for path in previous.keys() - current.keys():
+                self.queue.put_nowait(("deleted", path))
+            for path in current.keys() & previous.keys():
+                if current[path] != previous[path]:
+                    self.queue.put_nowait(("modified", path))
+            previous = current
+
+    def read_appended(self, path: str) -> Optional[str]:
+        """Возвращает байты, дописанные в файл с прошлого события"""
+        try:
+            size = os.path.getsize(path)
+            offset = self.offsets.get(path, 0)
+            if size < offset:
+                offset = 0  # Файл усечён или пересоздан
+            with open(path, "rb") as f:
+                f.seek(offset)
+                chunk = f.read(min(size - offset, WATCH_TAIL_MAX_BYTES))
+            self.offsets[path] = offset + len(chunk)
+            return chunk.decode("utf-8", errors="replace")
+        except OSError:
+            return None
+
+    def close(self):
+        if self.poll_task:
+            self.poll_task.cancel()
+        if self.fd is not None:
+            self.loop.remove_reader(self.fd)
+            os.close(self.fd)
+            self.fd = None
+
+
+def merge_watch_event(pending: Dict[str, str], kind: str, path: str):
+    """Схлопывает события одного пути в пределах окна debounce"""
+    previous = pending.get(path)
+    if previous == "created" and kind == "modified":
+        return
+    if previous == "deleted" and kind == "created":
+        kind = "modified"
+    pending[path] = kind
+
+
+@app.get("/watch")
+async def watch(request: Request, paths: List[str] = Query(...), agent_id: Optional[str] = None,
+                tail: bool = False, debounce_ms: int = 200):
+    """Server-Sent Events с изменениями файлов по путям или glob-шаблонам"""
+    for path in paths:
+        if is_forbidden_path(path):
+            logger.error(f"Недопустимый путь: {path}")
+            raise HTTPException(status_code=400, detail="Недопустимый путь")
+
+    owner = agent_id or ""
+    with watch_counts_lock:
+        if sum(watch_counts.values()) >= WATCH_MAX_TOTAL:
+            raise HTTPException(status_code=429, detail="Превышено число подписок на сервере")
+        if agent_id and watch_counts.get(owner, 0) >= WATCH_MAX_PER_AGENT:
+            raise HTTPException(status_code=429, detail=f"Превышено число подписок агента ({WATCH_MAX_PER_AGENT})")
+        watch_counts[owner] = watch_counts.get(owner, 0) + 1
+
+    try:
+        watcher = FileWatcher(paths, tail)
+        watcher.start()
+    except BaseException:
+        with watch_counts_lock:
+            watch_counts[owner] -= 1
+        raise
+
+    logger.info(f"Подписка на изменения: {paths}")
+    if agent_id:
+        await run_in_threadpool(log_agent_call, agent_id, "watch", {"success": True, "paths": paths, "tail": tail})
+
+    def sse(event: str, data: Dict[str, Any]) -> str:
+        return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+    async def event_stream():
+        loop = asyncio.get_running_loop()
+        debounce = max(0, debounce_ms) / 1000
+        try:
+            yield sse("ready", {
+                "paths": paths,
+                "directories": watcher.watch_dirs,
+                "backend": "inotify" if INOTIFY_AVAILABLE else "polling"
+            })
+            while True:
+                try:
+                    first = await asyncio.wait_for(watcher.queue.get(), timeout=WATCH_HEARTBEAT)
+                except asyncio.TimeoutError:
+                    yield ": ping\n\n"
+                    continue
+
+                pending = {}
+                overflow = False
+                batch = [first]
+                deadline = loop.time() + debounce
+                while True:
+                    for kind, path in batch:
+                        if kind == "overflow":
+                            overflow = True
+                        else:
+                            merge_watch_event(pending, kind, path)
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        break
+                    try:
+                        batch = [await asyncio.wait_for(watcher.queue.get(), timeout=remaining)]
+                    except asyncio.TimeoutError:
+                        break
+
+                if overflow:
+                    yield sse("overflow", {"message": "Очередь событий переполнена, часть изменений пропущена"})
+                for path, kind in pending.items():
+                    event = {"type": kind, "path": path, "timestamp": datetime.now().isoformat()}
+                    if tail and kind in ("created", "modified") and os.path.isfile(path):
+                        event["data"] = watcher.read_appended(path)
+                    yield sse("change", event)
+        finally:
+            watcher.close()
+            with watch_counts_lock:
+                watch_counts[owner] -= 1
+                if not watch_counts[owner]:
+                    del watch_counts[owner]
+            logger.info(f"Подписка на изменения завершена: {paths}")
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+# ===== WebSocket JSON-RPC транспорт =====
+
+RPC_MAX_CONCURRENT = 32
+
+# Методы JSON-RPC -> (обработчик, модель параметров)
+RPC_METHODS = {
+    "run_bash": (run_bash, BashCommand),
+    "run_python": (run_python, RunPythonRequest),
+    "write_file": (write_file, FileWriteRequest),
+    "read_file": (read_file, FileReadRequest),
+    "list_dir": (list_dir, DirListRequest),
+    "manifest": (manifest, ManifestRequest),
+    "sync_signature": (sync_signature, SyncSignatureRequest),
+    "sync_delta": (sync_delta, SyncDeltaRequest),
+    "sync_patch": (sync_patch, SyncPatchRequest),
+    "graph_query": (graph_query, GraphQueryRequest),
+    "graph_neighborhood": (graph_neighborhood, GraphNeighborhoodRequest),
+    "graph_search": (graph_search, GraphSearchRequest),
+    "graph_update": (graph_update, GraphUpdateRequest),
+    "agent_status": (agent_status, AgentStatusRequest),
+    "agent_list": (agent_list, AgentListRequest),
+    "agent_history": (agent_history, AgentHistoryRequest),
+    "agent_limits": (agent_limits, AgentLimitsRequest),
+    "agent_stats": (agent_stats, AgentStatsRequest),
+    "agent_pipeline": (agent_pipeline, AgentPipelineRequest),
+}
+
+# HTTP-пути методов: под ними вызовы по WebSocket попадают в трассу трафика
+RPC_PATHS = {
+    name: route.path
+    for name, (handler, _) in RPC_METHODS.items()
+    for route in app.routes
+    if getattr(route, "endpoint", None) is handler
+}
+
+# Активные WebSocket-подключения для server-push уведомлений
+ws_connections = set()
+
+
+def is_valid_rpc_id(value: Any) -> bool:
+    """id в JSON-RPC 2.0 — строка, число или null"""
+    return value is None or (isinstance(value, (str, int, float)) and not isinstance(value, bool))
+
+
+def rpc_error(request_id, code: int, message: str, data: Any = None) -> Dict[str, Any]:
+    """Формирует ответ JSON-RPC с ошибкой"""
+    error = {"code": code, "message": message}
+    if data is not None:
+        error["data"] = data
+    return {"jsonrpc": "2.0", "id": request_id, "error": error}
+
+
+class RpcConnection:
+    """Одно WebSocket-подключение с мультиплексированием запросов JSON-RPC"""
+
+    def __init__(self, websocket: WebSocket, loop: asyncio.AbstractEventLoop):
+        self.websocket = websocket
+        self.loop = loop
+        self.send_lock = asyncio.Lock()
+        self.semaphore = asyncio.Semaphore(RPC_MAX_CONCURRENT)
+        self.tasks = {}
+        self.cancel_events = {}
+
+    async def send(self, message: Any):
+        async with self.send_lock:
+            await self.websocket.send_text(json.dumps(jsonable_encoder(message)))
+
+    async def notify(self, method: str, params: Dict[str, Any]):
+        await self.send({"jsonrpc": "2.0", "method": method, "params": params})
+
+    def notify_threadsafe(self, method: str, params: Dict[str, Any]):
+        """Отправляет уведомление из рабочего потока"""
+        asyncio.run_coroutine_threadsafe(self.notify(method, params), self.loop)
+
+    async def handle_message(self, raw: str):
+        try:
+            message = json.loads(raw)
+        except ValueError:
+            await self.send(rpc_error(None, -32700, "Parse error"))
+            return
+
+        if isinstance(message, list):
+            if not message:
+                await self.send(rpc_error(None, -32600, "Invalid Request"))
+                return
+            responses = await asyncio.gather(*(self.dispatch(item) for item in message))
+            responses = [r for r in responses if r is not None]
+            if responses:
+                await self.send(responses)
+            return
+
+        response = await self.dispatch(message)
+        if response is not None:
+            await self.send(response)
+
+    async def dispatch(self, message: Any) -> Optional[Dict[str, Any]]:
+        if not isinstance(message, dict) or not isinstance(message.get("method"), str):
+            return rpc_error(None, -32600, "Invalid Request")
+
+        request_id = message.get("id")
+        if not is_valid_rpc_id(request_id):
+            return rpc_error(None, -32600, "Invalid Request")
+        method = message["method"]
+        params = message.get("params") or {}
+
+        if method == "$/cancelRequest":
+            # Останавливает команды run_bash, agent_pipeline и сниппеты run_python; прочие
+            # методы дорабатывают в пуле потоков, но их результат уже не отправляется
+            cancel_id = params.get("id") if isinstance(params, dict) else None
+            if is_valid_rpc_id(cancel_id) and cancel_id is not None:
+                cancel = self.cancel_events.get(cancel_id)
+                if cancel:
+                    cancel.set()
+                task = self.tasks.get(cancel_id)
+                if task:
+                    task.cancel()
+            return None
+
+        if method == "porta/methods":
+            return {"jsonrpc": "2.0", "id": request_id, "result": sorted(RPC_METHODS)}
+
+        if method not in RPC_METHODS:
+            return rpc_error(request_id, -32601, f"Метод не найден: {method}")
+        if not isinstance(params, dict):
+            return rpc_error(request_id, -32602, "Параметры должны быть объектом")
+
+        task = asyncio.current_task()
+        cancel = threading.Event()
+        if request_id is not None:
+            self.tasks[request_id] = task
+            self.cancel_events[request_id] = cancel
+        command_cancel.set(cancel)
+        started = time.time()
+        status = 500
+        try:
+            await self.semaphore.acquire()
+            # Вызовы по WebSocket делят серверный лимит параллелизма с HTTP
+            if not concurrency_limiter.try_acquire(priority=False):
+                self.semaphore.release()
+                status = 503
+                logger.warning(f"Перегрузка: RPC {method} отклонён (лимит {int(concurrency_limiter.limit)})")
+                return rpc_error(request_id, -32000, "Сервер перегружен, повторите запрос позже",
+                                 {"status": 503, "retry_after": CONCURRENCY_RETRY_AFTER})
+            call_started = time.monotonic()
+            work = asyncio.ensure_future(self.call(request_id, method, dict(params)))
+
+            def release_slots(future: asyncio.Future):
+                # Слоты освобождаются, когда обработчик в пуле потоков действительно
+                # завершился, а не при отмене запроса: иначе цикл запрос+отмена обходил бы лимиты
+                self.semaphore.release()
+                concurrency_limiter.release(time.monotonic() - call_started)
+                if not future.cancelled():
+                    future.exception()
+
+            work.add_done_callback(release_slots)
+            result = await asyncio.shield(work)
+            status = 200
+            if request_id is None:
+                return None
+            return {"jsonrpc": "2.0", "id": request_id, "result": result}
+        except asyncio.CancelledError:
+            status = 499
+            return rpc_error(request_id, -32800, "Запрос отменён")
+        except ValidationError as e:
+            status = 422
+            return rpc_error(request_id, -32602, "Invalid params", jsonable_encoder(e.errors()))
+        except HTTPException as e:
+            status = e.status_code
+            return rpc_error(request_id, -32000, str(e.detail), {"status": e.status_code})
+        except Exception as e:
+            logger.error(f"Ошибка выполнения RPC {method}: {e}")
+            return rpc_error(request_id, -32603, f"Внутренняя ошибка: {str(e)}")
+        finally:
+            self.tasks.pop(request_id, None)
+            self.cancel_events.pop(request_id, None)
+            self.capture(method, params, started, status)
+
+    @staticmethod
+    def capture(method: str, params: Dict[str, Any], started: float, status: int):
+        """Пишет вызов в трассу как эквивалентный HTTP-запрос, если задан PORTA_CAPTURE"""
+        path = RPC_PATHS.get(method)
+        if traffic_recorder is None or path is None or path.startswith(CAPTURE_SKIP_PREFIXES):
+            return
+        try:
+            traffic_recorder.record(started, "POST", path, "", json.dumps(params).encode("utf-8"),
+                                    status, time.time() - started)
+        except Exception as e:
+            logger.error(f"Ошибка записи трафика: {e}")
+
+    async def call(self, request_id, method: str, params: Dict[str, Any]):
+        handler, model = RPC_METHODS[method]
+        request_started.set(time.time())
+        stream = bool(params.pop("stream", False))
+        request = model(**params)
+
+        if method == "agent_pipeline" and stream:
+            # Частичные результаты уходят уведомлениями по мере выполнения команд
+            def on_result(result: Dict[str, Any]):
+                self.notify_threadsafe("porta/progress", {"id": request_id, "result": result})
+            return await run_in_threadpool(execute_pipeline, request, on_result)
+
+        return await run_in_threadpool(handler, request)
+
+
+def broadcast_notification(method: str, params: Dict[str, Any]):
+    """Рассылает уведомление всем подключённым WebSocket-клиентам (из любого потока)"""
+    for connection in list(ws_connections):
+        try:
+            connection.notify_threadsafe(method, params)
+        except RuntimeError:
+            ws_connections.discard(connection)
+
+
+@app.websocket("/ws")
+async def websocket_rpc(websocket: WebSocket):
+    """Постоянное подключение JSON-RPC 2.0 с мультиплексированием запросов"""
+    await websocket.accept()
+    connection = RpcConnection(websocket, asyncio.get_running_loop())
+    ws_connections.add(connection)
+    pending = set()
+    logger.info("WebSocket-клиент подключён")
+
+    try:
+        await connection.notify("porta/ready", {
+            "name": "Porta MCP",
+            "version": "1.3.0",
+            "methods": sorted(RPC_METHODS)
+        })
+        while True:
+            raw = await websocket.receive_text()
+            task = asyncio.create_task(connection.handle_message(raw))
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+    except WebSocketDisconnect:
+        logger.info("WebSocket-клиент отключён")
+    finally:
+        ws_connections.discard(connection)
+        for cancel in list(connection.cancel_events.values()):
+            cancel.set()
+        for task in pending:
+            task.cancel()
+
+
+# ===== Фоновая инициализация и готовность =====
+
+def warm_memory_bank():
+    """Загружает графы всех проектов Memory Bank в индексированное хранилище"""
+    if not os.path.isdir(MEMORY_BANK_DIR):
+        return
+    for project in sorted(os.listdir(MEMORY_BANK_DIR)):
+        if os.path.exists(os.path.join(MEMORY_BANK_DIR, project, "graph.json")):
+            get_graph_store(project)
+
+
+def start_continuous_profiler():
+    if os.getenv("PORTA_PROFILER_CONTINUOUS") == "1":
+        continuous_profiler.start()
+
+
+# Компоненты в порядке инициализации: (имя, функция, нужна ли для готовности)
+STARTUP_COMPONENTS = [
+    ("agents_db", ensure_agents_db, True),
+    ("analytics", agent_analytics.load, True),
+    ("memory_bank", warm_memory_bank, False),
+    ("graph_snapshots", start_graph_snapshots, False),
+    ("command_launcher", get_command_launcher, False),
+    ("python_workers", python_pool.start, False),
+    ("profiler", start_continuous_profiler, False),
+]
+
+component_status = {name: {"status": "pending", "critical": critical} for name, _, critical in STARTUP_COMPONENTS}
+component_status_lock = threading.Lock()
+
+
+def run_startup_components():
+    """Инициализирует компоненты в фоне, обновляя их статус для /readyz"""
+    for name, init, critical in STARTUP_COMPONENTS:
+        with component_status_lock:
+            component_status[name] = {"status": "initializing", "critical": critical}
+        started = time.time()
+        try:
+            init()
+            status = {"status": "ready"}
+        except Exception as e:
+            logger.error(f"Ошибка инициализации компонента {name}: {e}")
+            status = {"status": "failed", "error": str(e)}
+        status.update(critical=critical, duration_ms=round((time.time() - started) * 1000, 2))
+        with component_status_lock:
+            component_status[name] = status
+    logger.info("Фоновая инициализация завершена")
+
+
+def shutdown_components():
+    """Сохраняет состояние и останавливает фоновые процессы при остановке сервера"""
+    for name, action in (
+        ("analytics", agent_analytics.flush),
+        ("graph_snapshots", graph_snapshot_stop.set),
+        ("memory_bank", lambda: snapshot_graph_stores(force=True)),
+        ("command_launcher", stop_command_launcher),
+        ("python_workers", python_pool.stop),
+        ("profiler", continuous_profiler.stop),
+        ("capture", traffic_recorder.close if traffic_recorder else lambda: None),
+    ):
+        try:
+            action()
+        except Exception as e:
+            logger.error(f"Ошибка остановки компонента {name}: {e}")
+
+
+@app.get("/healthz")
+def healthz():
+    """Liveness: процесс жив и обрабатывает запросы"""
+    return {"status": "ok", "uptime": get_uptime(), "pid": os.getpid()}
+
+
+@app.get("/readyz")
+def readyz():
+    """Readiness: готовы ли компоненты, без которых сервер не может работать"""
+    with component_status_lock:
+        components = {name: dict(status) for name, status in component_status.items()}
+    ready = all(s["status"] == "ready" for s in components.values() if s["critical"])
+    return JSONResponse(
+        content={"ready": ready, "uptime": get_uptime(), "components": components},
+        status_code=200 if ready else 503
+    )
+
+
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8111)
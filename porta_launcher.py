@@ -0,0 +1,138 @@
+"""Форк-сервер shell-команд для execute_command.
+
+Процесс запускается один раз (python -S, без site) и на каждый запрос делает
+fork: потомок создаёт сессию, переходит в cgroup команды, выставляет rlimits и
+выполняет exec /bin/sh -c. Старт интерпретатора не входит в стоимость команды,
+а wait4 возвращает rusage именно её дерева процессов: сервер в цепочку
+fork/exec не попадает, поэтому его пик RSS не переносится в ru_maxrss.
+
+Протокол — JSON-датаграммы по SOCK_SEQPACKET-сокету, номер которого передаётся
+аргументом. К запросу приложены дескрипторы stdout и stderr команды. Ответы:
+{"id", "pid"} после запуска и {"id", "returncode", ...rusage} после завершения.
+
+Использование: porta_launcher.py <fd сокета>
+"""
+import json
+import os
+import resource
+import selectors
+import signal
+import socket
+import sys
+
+
+def apply_limits(limits):
+    """Устанавливает rlimits в дочернем процессе перед exec"""
+    if limits.get("cpu_seconds") is not None:
+        resource.setrlimit(resource.RLIMIT_CPU, (limits["cpu_seconds"], limits["cpu_seconds"]))
+    if limits.get("memory_mb") is not None:
+        memory = limits["memory_mb"] * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (memory, memory))
+
+
+def run_child(request, fds):
+    """Выполняется в форкнутом процессе и никогда не возвращается"""
+    try:
+        os.setsid()
+        signal.set_wakeup_fd(-1)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+
+        devnull = os.open(os.devnull, os.O_RDONLY)
+        os.dup2(devnull, 0)
+        os.dup2(fds[0], 1)
+        os.dup2(fds[1], 2)
+        for fd in (devnull, *fds):
+            os.close(fd)
+
+        if request.get("cgroup"):
+            # pids.max считает все процессы cgroup, поэтому входим до exec
+            with open(os.path.join(request["cgroup"], "cgroup.procs"), "w") as f:
+                f.write(str(os.getpid()))
+        if request.get("cwd"):
+            os.chdir(request["cwd"])
+        if request.get("limits"):
+            apply_limits(request["limits"])
+        os.execv("/bin/sh", ["/bin/sh", "-c", request["cmd"]])
+    except BaseException as e:
+        os.write(2, f"porta_launcher: {e}\n".encode("utf-8"))
+    finally:
+        os._exit(127)
+
+
+def main():
+    sock = socket.socket(fileno=int(sys.argv[1]))
+    sock.set_inheritable(False)
+
+    def send(message):
+        sock.send(json.dumps(message).encode("utf-8"))
+
+    wakeup_r, wakeup_w = os.pipe()
+    os.set_blocking(wakeup_r, False)
+    os.set_blocking(wakeup_w, False)
+    signal.set_wakeup_fd(wakeup_w)
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+
+    selector = selectors.DefaultSelector()
+    selector.register(sock, selectors.EVENT_READ, "request")
+    selector.register(wakeup_r, selectors.EVENT_READ, "wakeup")
+
+    children = {}  # pid -> request_id
+
+    while True:
+        for key, _ in selector.select():
+            if key.data == "wakeup":
+                try:
+                    while os.read(wakeup_r, 512):
+                        pass
+                except BlockingIOError:
+                    pass
+                continue
+
+            message, fds, _, _ = socket.recv_fds(sock, 65536, 2)
+            if not message:
+                # Сервер закрыл сокет — завершаем оставшиеся команды и выходим
+                for pid in children:
+                    try:
+                        os.killpg(pid, signal.SIGKILL)
+                    except ProcessLookupError:
+                        pass
+                return
+            request = json.loads(message)
+            try:
+                pid = os.fork()
+            except OSError as e:
+                send({"id": request["id"], "error": str(e)})
+                pid = None
+            if pid == 0:
+                run_child(request, fds)
+            for fd in fds:
+                os.close(fd)
+            if pid:
+                children[pid] = request["id"]
+                send({"id": request["id"], "pid": pid})
+
+        # Собираем завершившиеся команды
+        while children:
+            try:
+                pid, status, usage = os.wait4(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                break
+            request_id = children.pop(pid, None)
+            if request_id is None:
+                continue
+            send({
+                "id": request_id,
+                "returncode": -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status),
+                "user_cpu": usage.ru_utime,
+                "sys_cpu": usage.ru_stime,
+                "max_rss_kb": usage.ru_maxrss,
+                "read_bytes": usage.ru_inblock * 512,
+                "write_bytes": usage.ru_oublock * 512
+            })
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+"""Тёплый Python-воркер для /run_python.
+
+Процесс один раз импортирует модули из списка предзагрузки, а затем на каждый
+запрос делает fork: сниппет выполняется в copy-on-write копии уже прогретого
+интерпретатора, без повторного старта Python и импортов.
+
+Протокол — JSON-строки: запросы приходят на stdin, ответы уходят в stdout.
+Вывод сниппета пишется в файлы, пути к которым передаёт сервер.
+"""
+import importlib
+import json
+import os
+import resource
+import selectors
+import signal
+import sys
+import time
+import traceback
+
+
+def apply_limits(limits):
+    """Устанавливает rlimits в дочернем процессе"""
+    if limits.get("cpu_seconds") is not None:
+        resource.setrlimit(resource.RLIMIT_CPU, (limits["cpu_seconds"], limits["cpu_seconds"]))
+    if limits.get("memory_mb") is not None:
+        memory = limits["memory_mb"] * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (memory, memory))
+
+
+def run_child(request, protocol_fds):
+    """Выполняется в форкнутом процессе и никогда не возвращается"""
+    exit_code = 0
+    try:
+        os.setsid()
+        signal.set_wakeup_fd(-1)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        for fd in protocol_fds:
+            os.close(fd)
+
+        devnull = os.open(os.devnull, os.O_RDONLY)
+        os.dup2(devnull, 0)
+        out_fd = os.open(request["stdout_path"], os.O_WRONLY | os.O_TRUNC)
+        err_fd = os.open(request["stderr_path"], os.O_WRONLY | os.O_TRUNC)
+        os.dup2(out_fd, 1)
+        os.dup2(err_fd, 2)
+        sys.stdin = open(0, "r", closefd=False)
+        sys.stdout = open(1, "w", closefd=False)
+        sys.stderr = open(2, "w", closefd=False)
+
+        if request.get("cgroup"):
+            with open(os.path.join(request["cgroup"], "cgroup.procs"), "w") as f:
+                f.write(str(os.getpid()))
+        if request.get("cwd"):
+            os.chdir(request["cwd"])
+        if request.get("limits"):
+            apply_limits(request["limits"])
+
+        if request.get("path"):
+            import runpy
+            sys.argv = [request["path"]] + request.get("args", [])
+            sys.path.insert(0, os.path.dirname(os.path.abspath(request["path"])))
+            runpy.run_path(request["path"], run_name="__main__")
+        else:
+            sys.argv = ["-c"] + request.get("args", [])
+            code = compile(request["code"], "<snippet>", "exec")
+            exec(code, {"__name__": "__main__", "__builtins__": __builtins__})
+    except SystemExit as e:
+        if e.code is None:
+            exit_code = 0
+        elif isinstance(e.code, int):
+            exit_code = e.code
+        else:
+            print(e.code, file=sys.stderr)
+            exit_code = 1
+    except BaseException:
+        traceback.print_exc()
+        exit_code = 1
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(exit_code)
+
+
+def main():
+    preload = [name.strip() for name in sys.argv[1:] if name.strip()]
+    loaded, failed = [], {}
+    for name in preload:
+        try:
+            importlib.import_module(name)
+            loaded.append(name)
+        except Exception as e:
+            failed[name] = str(e)
+
+    # Протокол уходит через отдельные дескрипторы, а 0/1 освобождаем для сниппетов
+    protocol_in = os.dup(0)
+    protocol_out = os.dup(1)
+    devnull = os.open(os.devnull, os.O_RDWR)
+    os.dup2(devnull, 0)
+    os.dup2(devnull, 1)
+
+    def send(message):
+        os.write(protocol_out, (json.dumps(message) + "\n").encode("utf-8"))
+
+    wakeup_r, wakeup_w = os.pipe()
+    os.set_blocking(wakeup_r, False)
+    os.set_blocking(wakeup_w, False)
+    signal.set_wakeup_fd(wakeup_w)
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+
+    selector = selectors.DefaultSelector()
+    selector.register(protocol_in, selectors.EVENT_READ, "request")
+    selector.register(wakeup_r, selectors.EVENT_READ, "wakeup")
+
+    children = {}  # pid -> (request_id, deadline, started, timed_out)
+    buffer = b""
+    send({"ready": True, "pid": os.getpid(), "preloaded": loaded, "failed": failed})
+
+    while True:
+        now = time.monotonic()
+        deadlines = [deadline for _, deadline, _, _ in children.values() if deadline]
+        timeout = max(0.0, min(deadlines) - now) if deadlines else None
+
+        for key, _ in selector.select(timeout):
+            if key.data == "wakeup":
+                try:
+                    while os.read(wakeup_r, 512):
+                        pass
+                except BlockingIOError:
+                    pass
+                continue
+
+            chunk = os.read(protocol_in, 65536)
+            if not chunk:
+                # Сервер закрыл канал — завершаем оставшиеся сниппеты и выходим
+                for pid in children:
+                    try:
+                        os.killpg(pid, signal.SIGKILL)
+                    except ProcessLookupError:
+                        pass
+                return
+            buffer += chunk
+            while b"\n" in buffer:
+                line, buffer = buffer.split(b"\n", 1)
+                if not line.strip():
+                    continue
+                request = json.loads(line)
+                if "kill" in request:
+                    # Отмена запроса сервером: убиваем сниппет, ответ уйдёт при его сборке
+                    for pid, (request_id, _, _, _) in children.items():
+                        if request_id == request["kill"]:
+                            try:
+                                os.killpg(pid, signal.SIGKILL)
+                            except ProcessLookupError:
+                                pass
+                    continue
+                pid = os.fork()
+                if pid == 0:
+                    run_child(request, (protocol_in, protocol_out, wakeup_r, wakeup_w))
+                timeout_seconds = request.get("timeout")
+                deadline = time.monotonic() + timeout_seconds if timeout_seconds else None
+                children[pid] = (request["id"], deadline, time.monotonic(), False)
+
+        # Убиваем сниппеты, превысившие таймаут
+        now = time.monotonic()
+        for pid, (request_id, deadline, started, _) in list(children.items()):
+            if deadline and now >= deadline:
+                try:
+                    os.killpg(pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+                children[pid] = (request_id, None, started, True)
+
+        # Собираем завершившиеся процессы
+        while children:
+            try:
+                pid, status, usage = os.wait4(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                break
+            if pid not in children:
+                continue
+            request_id, _, started, timed_out = children.pop(pid)
+            returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+            send({
+                "id": request_id,
+                "returncode": returncode,
+                "timed_out": timed_out,
+                "resources": {
+                    "wall_time": round(time.monotonic() - started, 4),
+                    "user_cpu": round(usage.ru_utime, 4),
+                    "sys_cpu": round(usage.ru_stime, 4),
+                    "max_rss_kb": usage.ru_maxrss,
+                    "read_bytes": usage.ru_inblock * 512,
+                    "write_bytes": usage.ru_oublock * 512
+                }
+            })
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+"""Воспроизведение трассы запросов, записанной Porta с PORTA_CAPTURE.
+
+Трасса воспроизводится на настоящем сервере, поэтому изменяющие запросы требуют
+явного выбора: --root переносит все пути в scratch-директорию, --allow-writes
+разрешает писать по исходным путям. Команды и код, записанные обезличенными,
+заменяются пустыми операциями той же длины; записанные как есть
+(PORTA_CAPTURE_COMMANDS=1) выполняются только с --allow-exec.
+
+Примеры:
+    python3 scripts/replay_trace.py traces/porta.jsonl.gz --dry-run
+    python3 scripts/replay_trace.py traces/porta.jsonl.gz --root /tmp/porta-replay
+    python3 scripts/replay_trace.py traces/porta.jsonl.gz --root /tmp/porta-replay --speed 2 \
+        --output logs/replay/after.json --compare logs/replay/before.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+import zlib
+from collections import Counter
+from datetime import datetime
+from urllib.parse import parse_qsl, urlencode
+
+import httpx
+
+# Конфигурация
+PORTA_URL = "http://localhost:8111"
+TOKEN = "test123"
+HEADERS = {"X-PORTA-TOKEN": TOKEN, "Content-Type": "application/json"}
+
+# Запросы, изменяющие состояние сервера
+WRITE_PATHS = ("/write_file", "/sync/patch", "/archive/upload", "/graph/update", "/agent/limits")
+# Из них те, чьи пути можно перенести в --root; остальные пишут в Memory Bank и БД агентов
+REMAPPABLE_WRITE_PATHS = ("/write_file", "/sync/patch", "/archive/upload")
+PATH_FIELDS = ("path",)
+COMMAND_FIELDS = ("cmd", "commands")
+CODE_FIELDS = ("code",)
+
+
+def read_trace_text(path):
+    """Читает трассу целиком; у gzip допускаются несколько членов и оборванный хвост"""
+    with open(path, "rb") as f:
+        raw = f.read()
+    if not path.endswith(".gz"):
+        return raw.decode("utf-8", errors="replace")
+
+    # Трасса пишется с flush без закрытия файла, поэтому gzip.open на ней падает с EOFError
+    chunks = []
+    while raw:
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        chunks.append(decompressor.decompress(raw))
+        raw = decompressor.unused_data
+    return b"".join(chunks).decode("utf-8", errors="replace")
+
+
+def load_trace(path):
+    """Возвращает записи трассы без заголовков, отсортированные по времени"""
+    records = []
+    for line in read_trace_text(path).splitlines():
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            continue
+        if "trace" in record:
+            continue
+        records.append(record)
+    records.sort(key=lambda r: r["t"])
+    return records
+
+
+def is_redacted(value):
+    return isinstance(value, dict) and set(value) == {"__redacted__"}
+
+
+def placeholder(field, length):
+    """Безопасная замена той же длины: для команд — пустая команда shell, для кода — комментарий"""
+    if field in COMMAND_FIELDS:
+        return (": " + "x" * length)[:max(length, 1)]
+    if field in CODE_FIELDS:
+        return "#" + "x" * max(length - 1, 0)
+    return "x" * length
+
+
+def restore_payload(value, field=None, allow_exec=False):
+    """Подставляет синтетическое содержимое той же длины вместо обезличенных полей.
+
+    Команды и код, записанные как есть, без allow_exec тоже заменяются пустыми операциями.
+    """
+    if is_redacted(value):
+        return placeholder(field, value["__redacted__"])
+    if isinstance(value, dict):
+        return {key: restore_payload(item, key, allow_exec) for key, item in value.items()}
+    if isinstance(value, list):
+        return [restore_payload(item, field, allow_exec) for item in value]
+    if isinstance(value, str) and field in COMMAND_FIELDS + CODE_FIELDS and not allow_exec:
+        return placeholder(field, len(value))
+    return value
+
+
+def remap_path(path, root):
+    """Переносит путь из трассы внутрь root"""
+    return os.path.join(root, path.lstrip("/"))
+
+
+def remap_paths(value, root):
+    if isinstance(value, dict):
+        return {key: remap_path(item, root) if key in PATH_FIELDS and isinstance(item, str) else remap_paths(item, root)
+                for key, item in value.items()}
+    if isinstance(value, list):
+        return [remap_paths(item, root) for item in value]
+    return value
+
+
+def prepare_records(records, root=None, allow_writes=False, allow_exec=False):
+    """Готовит запросы к отправке и возвращает (запросы, пропущенные по эндпоинтам)"""
+    prepared = []
+    skipped = Counter()
+    for record in records:
+        path = record["p"]
+        if path in WRITE_PATHS and not allow_writes and (root is None or path not in REMAPPABLE_WRITE_PATHS):
+            skipped[path] += 1
+            continue
+        payload = restore_payload(record["b"], allow_exec=allow_exec) if "b" in record else None
+        if path == "/run_python" and isinstance(payload, dict) and payload.get("path") and not allow_exec:
+            # Скрипт с диска без --allow-exec заменяется пустым сниппетом
+            payload = {**payload, "code": placeholder("code", len(payload["path"]))}
+            payload.pop("path")
+        query = record.get("q", "")
+        if root is not None:
+            payload = remap_paths(payload, root)
+            if query:
+                query = urlencode([(k, remap_path(v, root) if k in PATH_FIELDS else v)
+                                   for k, v in parse_qsl(query, keep_blank_values=True)])
+        prepared.append({**record, "b": payload, "q": query})
+    return prepared, skipped
+
+
+async def send_request(client, base_url, record, results):
+    url = base_url + record["p"] + (f"?{record['q']}" if record.get("q") else "")
+    payload = record["b"]
+    start = time.time()
+    try:
+        resp = await client.request(record["m"], url, headers=HEADERS, json=payload, timeout=120.0)
+        status = resp.status_code
+    except Exception as e:
+        print(f"[{record['p']}] ERROR: {e}")
+        status = None
+    duration = (time.time() - start) * 1000  # в мс
+    results.append({"path": record["p"], "status": status, "latency_ms": duration, "original_ms": record.get("d")})
+
+
+async def replay(records, base_url, speed):
+    """Отправляет запросы с исходными интервалами, сжатыми в speed раз (0 — без пауз)"""
+    results = []
+    tasks = []
+    async with httpx.AsyncClient() as client:
+        started = time.time()
+        trace_start = records[0]["t"] if records else 0
+        for record in records:
+            if speed > 0:
+                delay = (record["t"] - trace_start) / speed - (time.time() - started)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(send_request(client, base_url, record, results)))
+        await asyncio.gather(*tasks)
+    return results
+
+
+def percentile(values, q):
+    if len(values) < 2:
+        return round(values[0], 2) if values else None
+    return round(statistics.quantiles(values, n=100)[q - 1], 2)
+
+
+def summarize(results):
+    """Распределение задержек по эндпоинтам"""
+    by_path = {}
+    for result in results:
+        by_path.setdefault(result["path"], []).append(result)
+
+    summary = {}
+    for path, items in sorted(by_path.items()):
+        latencies = [r["latency_ms"] for r in items if r["status"] and r["status"] < 500]
+        statuses = {}
+        for r in items:
+            statuses[str(r["status"])] = statuses.get(str(r["status"]), 0) + 1
+        summary[path] = {
+            "requests": len(items),
+            "errors": len(items) - len(latencies),
+            "statuses": statuses,
+            "avg_ms": round(statistics.mean(latencies), 2) if latencies else None,
+            "p50_ms": percentile(latencies, 50),
+            "p95_ms": percentile(latencies, 95),
+            "p99_ms": percentile(latencies, 99),
+        }
+    return summary
+
+
+def print_summary(summary, previous=None):
+    print(f"{'Endpoint':<24}{'req':>6}{'err':>5}{'p50':>10}{'p95':>10}{'p99':>10}")
+    print("=" * 65)
+    for path, stats in summary.items():
+        print(f"{path:<24}{stats['requests']:>6}{stats['errors']:>5}"
+              f"{str(stats['p50_ms']):>10}{str(stats['p95_ms']):>10}{str(stats['p99_ms']):>10}")
+        if previous and path in previous:
+            diffs = []
+            for key in ("p50_ms", "p95_ms", "p99_ms"):
+                old, new = previous[path].get(key), stats.get(key)
+                if old and new:
+                    change = (new - old) / old * 100
+                    marker = "📉" if change < -5 else "📈" if change > 5 else "➖"
+                    diffs.append(f"{key[:-3]} {change:+.1f}% {marker}")
+            if diffs:
+                print(f"{'':<24}  {'  '.join(diffs)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Воспроизведение трассы Porta")
+    parser.add_argument("trace", help="Файл трассы (.jsonl или .jsonl.gz)")
+    parser.add_argument("--url", default=os.getenv("PORTA_URL", PORTA_URL), help="Адрес экземпляра Porta")
+    parser.add_argument("--speed", type=float, default=1.0, help="Ускорение относительно оригинала, 0 — без пауз")
+    parser.add_argument("--output", help="Куда сохранить отчёт (JSON)")
+    parser.add_argument("--compare", help="Предыдущий отчёт для сравнения")
+    parser.add_argument("--root", help="Scratch-директория: все пути из трассы переносятся внутрь неё")
+    parser.add_argument("--allow-writes", action="store_true",
+                        help="Разрешить изменяющие запросы по исходным путям, в Memory Bank и БД агентов")
+    parser.add_argument("--allow-exec", action="store_true",
+                        help="Выполнять записанные как есть команды и код вместо пустых операций")
+    parser.add_argument("--dry-run", action="store_true", help="Только показать, что будет отправлено")
+    args = parser.parse_args()
+
+    records = load_trace(args.trace)
+    writes = Counter(r["p"] for r in records if r["p"] in WRITE_PATHS)
+    if writes and args.root is None and not args.allow_writes and not args.dry_run:
+        print(f"⛔ В трассе {sum(writes.values())} изменяющих запросов: "
+              + ", ".join(f"{path} x{count}" for path, count in sorted(writes.items())))
+        print("   Укажите --root <scratch-dir>, чтобы перенести пути, или --allow-writes, "
+              "чтобы писать по исходным путям. --dry-run покажет план без отправки.")
+        sys.exit(2)
+
+    root = os.path.abspath(args.root) if args.root else None
+    if root:
+        os.makedirs(root, exist_ok=True)
+    records, skipped = prepare_records(records, root, args.allow_writes, args.allow_exec)
+    for path, count in sorted(skipped.items()):
+        print(f"⏭️  Пропущено {path} x{count}: пишет вне --root, нужен --allow-writes")
+
+    if args.dry_run:
+        print(f"📝 Будет отправлено {len(records)} запросов на {args.url}" + (f", пути внутри {root}" if root else ""))
+        for path, count in sorted(Counter(r["p"] for r in records).items()):
+            print(f"   {path:<24}{count:>6}")
+        return
+
+    print(f"▶️  Воспроизведение {len(records)} запросов из {args.trace} (скорость x{args.speed})")
+    results = asyncio.run(replay(records, args.url, args.speed))
+    summary = summarize(results)
+
+    previous = None
+    if args.compare:
+        with open(args.compare, "r") as f:
+            previous = json.load(f)["endpoints"]
+    print_summary(summary, previous)
+
+    if args.output:
+        os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+        with open(args.output, "w") as f:
+            json.dump({
+                "timestamp": datetime.now().isoformat(),
+                "trace": args.trace,
+                "url": args.url,
+                "speed": args.speed,
+                "requests": len(results),
+                "endpoints": summary
+            }, f, indent=2)
+        print(f"📁 Отчёт сохранён в: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
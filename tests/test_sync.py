@@ -0,0 +1,69 @@
+import base64
+import os
+import random
+import sys
+
+from fastapi.testclient import TestClient
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import porta  # noqa: E402
+
+
+BLOCK_SIZE = 2048
+
+
+def signature(data: bytes):
+    blocks = []
+    for start in range(0, len(data), BLOCK_SIZE):
+        block = data[start:start + BLOCK_SIZE]
+        a, b = porta.weak_checksum(block)
+        blocks.append(porta.SyncBlock(weak=a | (b << 16), strong=porta.strong_checksum(block), size=len(block)))
+    return blocks
+
+
+def apply_delta(basis: bytes, data: bytes, ops):
+    out = bytearray()
+    for op in ops:
+        if op["op"] == "copy":
+            out += basis[op["index"] * BLOCK_SIZE:(op["index"] + op["count"]) * BLOCK_SIZE]
+        else:
+            out += data[op["start"]:op["end"]]
+    return bytes(out)
+
+
+def test_delta_resyncs_after_long_edit_and_short_insert():
+    rng = random.Random(26)
+    basis = bytes(rng.getrandbits(8) for _ in range(200 * 1024))
+    edit_start = 40 * 1024
+    edit_end = edit_start + 48 * 1024
+    # Вставка сразу за правкой сдвигает весь остаток файла внутри одного литерала
+    new = (
+        basis[:edit_start]
+        + bytes(rng.getrandbits(8) for _ in range(48 * 1024))
+        + b"INSERTED"
+        + basis[edit_end:]
+    )
+
+    ops = porta.compute_delta(new, BLOCK_SIZE, signature(basis))
+    literal_bytes = sum(op["end"] - op["start"] for op in ops if op["op"] == "data")
+
+    assert apply_delta(basis, new, ops) == new
+    # Правка и вставка плюс не больше пары блоков вокруг каждой
+    assert literal_bytes < 48 * 1024 + 4 * BLOCK_SIZE
+
+
+def test_sync_patch_rejects_invalid_base64(tmp_path):
+    client = TestClient(porta.app)
+    response = client.post("/sync/patch", json={
+        "path": str(tmp_path / "target.bin"),
+        "ops": [{"op": "data", "data": "not base64!"}]
+    })
+    assert response.status_code == 400
+
+    response = client.post("/sync/patch", json={
+        "path": str(tmp_path / "target.bin"),
+        "ops": [{"op": "data", "data": base64.b64encode(b"ok").decode("ascii")}]
+    })
+    assert response.status_code == 200
+    assert (tmp_path / "target.bin").read_bytes() == b"ok"